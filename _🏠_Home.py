@@ -8,7 +8,6 @@ import streamlit as st
 import numpy as np
 import matplotlib.pyplot as plt
 import qoplots.qoplots as qp
-import re
 from contextlib import nullcontext
 import logging
 import json
@@ -31,28 +30,54 @@ from data import (
     CSVFile,
     Color,
     DataSeries,
+    EditorChanges,
     FigureProperties,
     LegendEntry,
     Line,
     LineOfBestFit,
     Marker,
+    memory_usage,
+    NumericParseError,
+    parse_numbers,
+    state_fingerprint,
+    state_version,
 )
 from constants import CommentCharacters, MarkerStyles, LineStyles, Delimiters
-from fitting import fit, get_fitted_data
+from fitting import fit, fit_many, get_fitted_data
+from importers import ColumnTable, can_import, importers, import_file
+from compression import (
+    archive_members,
+    compressed_types,
+    decompress_bytes,
+    decompress_text,
+    inner_name,
+    is_archive,
+    is_compressed,
+)
+from history import CompoundChange, FieldsChange, History, RowsChange, SeriesListChange
+from storage import StaleSessionError
 from text import process_fit, process_units
 from errors import (
     handle_data_error,
     handle_fit_error,
+    handle_import_error,
     handle_json_error,
     handle_latex_error,
 )
 from persistence import (
-    clean_old_files,
     get_existing_key,
     get_new_key,
     load_data,
+    parse_csv,
     save_data,
     clear_data,
+    journal_enabled,
+    restore_revision,
+    session_revisions,
+    spill_large_series,
+    start_sweeper,
+    tab_save_state,
+    take_conflict,
 )
 
 
@@ -107,6 +132,16 @@ def format_elapsed_time(t_ns: float):
     return timestring + " " + unit
 
 
+def format_bytes(n: int) -> str:
+    if n < 1024:
+        return f"{n} B"
+    for unit in ["KiB", "MiB"]:
+        n /= 1024
+        if n < 1024:
+            return f"{n:.1f} {unit}"
+    return f"{n / 1024:.1f} GiB"
+
+
 logging.info("Starting App")
 
 # Setup ---------------------------------------
@@ -177,16 +212,46 @@ def change_active_series(name: str):
         raise ValueError(f"Series with name {name} not found.")
 
 
-def extract_data(text: str) -> np.array:
-    # data could be comma separated, space separated, tab separated, or new line separated
-    separated = re.split(r"[,\s\t\n]+", text)
-    if len(separated) == 1:
-        raise ValueError("No data found.")
-    try:
-        data = np.array([float(x) for x in separated])
-        return data
-    except ValueError:
-        raise ValueError("Data must be numeric.")
+def from_percent(value):
+    return value / 100
+
+
+def set_property(target, field: str, key: str, convert=None):
+    # set a property of a model object from the value of a widget, recording the change so it can be undone
+    value = st.session_state[key]
+    if convert is not None:
+        value = convert(value)
+    old = getattr(target, field)
+    if old == value:
+        return
+    st.session_state.history.record(FieldsChange(target, {field: old}, {field: value}, [key]))
+    setattr(target, field, value)
+
+
+def fix_active_series():
+    # after undoing or redoing, the active series may no longer exist
+    if st.session_state.active_series not in st.session_state.data_series:
+        if len(st.session_state.data_series) > 0:
+            st.session_state.active_series = st.session_state.data_series[-1]
+        else:
+            st.session_state.active_series = None
+
+
+def undo():
+    change = st.session_state.history.undo()
+    if change is not None:
+        # widgets still hold the values from before the undo, so reset them
+        for key in change.widget_keys:
+            st.session_state.pop(key, None)
+        fix_active_series()
+
+
+def redo():
+    change = st.session_state.history.redo()
+    if change is not None:
+        for key in change.widget_keys:
+            st.session_state.pop(key, None)
+        fix_active_series()
 
 
 def add_new_data(
@@ -195,11 +260,16 @@ def add_new_data(
         y_data: np.array = None,
 ):
     if x_data is None or y_data is None:
+        # parse_numbers already returns float arrays, so no further conversion is needed
+        try:
+            x_data = parse_numbers(st.session_state.new_x_data)
+        except Exception as e:
+            st.error(handle_data_error(e, st.session_state.new_x_data))
+            return
         try:
-            x_data = extract_data(st.session_state.new_x_data.strip())
-            y_data = extract_data(st.session_state.new_y_data.strip())
+            y_data = parse_numbers(st.session_state.new_y_data)
         except Exception as e:
-            st.error(handle_data_error(e))
+            st.error(handle_data_error(e, st.session_state.new_y_data))
             return
         if len(x_data) != len(y_data):
             st.error("The number of $x$-values must match the number of $y$-values.")
@@ -207,13 +277,6 @@ def add_new_data(
                 f"Number of x-values ({len(x_data)}) does not match number of y-values ({len(y_data)})."
             )
             return
-        try:
-            x_data = np.array([float(x) for x in x_data])
-            y_data = np.array([float(y) for y in y_data])
-        except ValueError:
-            st.error("The data must be numeric.")
-            logging.error("Data is not numeric.")
-            return
     if name is None:
         new_name = st.session_state.new_name
     else:
@@ -227,9 +290,18 @@ def add_new_data(
     # clear the new data
     st.session_state.new_x_data = ""
     st.session_state.new_y_data = ""
-    # create the new data series
-    s = DataSeries(
-        name=new_name,
+    s = new_series(new_name, x_data, y_data)
+    st.session_state.history.record(
+        SeriesListChange(st.session_state.data_series, len(st.session_state.data_series), s, added=True)
+    )
+    st.session_state.data_series.append(s)
+    st.session_state.active_series = s
+
+
+def new_series(name: str, x_data: np.array, y_data: np.array) -> DataSeries:
+    # create a data series with the default styling
+    return DataSeries(
+        name=name,
         x=x_data,
         y=y_data,
         marker=Marker(
@@ -244,7 +316,7 @@ def add_new_data(
         ),
         legend_entry=LegendEntry(
             show=True,
-            label=new_name,
+            label=name,
         ),
         line_of_best_fit=LineOfBestFit(
             show=False,
@@ -262,13 +334,45 @@ def add_new_data(
             ),
         ),
     )
-    st.session_state.data_series.append(s)
-    st.session_state.active_series = s
+
+
+def add_many_series(x_data: np.array, y_data: dict, fit_type: str):
+    # y_data maps the name of each new series to its y-values. Every series is created in one go, so the figure
+    # is only redrawn and saved once, and any fits are run in parallel.
+    existing = [s.name for s in st.session_state.data_series]
+    clashes = [name for name in y_data if name in existing]
+    if len(clashes) > 0:
+        st.error(f"Data series with the names {', '.join(clashes)} already exist.")
+        logging.error(f"Data series with names {clashes} already exist.")
+        return
+    series = [new_series(name, x_data.copy(), y.copy()) for name, y in y_data.items()]
+    if fit_type != "None":
+        results = fit_many(fit_type, [(s.x, s.y, s.stats) for s in series])
+        for s, result in zip(series, results):
+            s.line_of_best_fit.fit_type = fit_type
+            s.line_of_best_fit.show = True
+            if isinstance(result, Exception):
+                st.error(handle_fit_error(result, fit_type, s.name))
+                s.line_of_best_fit.attempt_plot = False
+            else:
+                s.line_of_best_fit.fit_params, s.line_of_best_fit.r_squared = result
+    n = len(st.session_state.data_series)
+    st.session_state.history.record(
+        CompoundChange(
+            [SeriesListChange(st.session_state.data_series, n + i, s, added=True) for i, s in enumerate(series)]
+        )
+    )
+    st.session_state.data_series.extend(series)
+    st.session_state.active_series = series[-1]
+
 
 def delete_series(s_name: str):
     # remove the series. If it is the active series, set the active series to the first (or None)
-    for s in st.session_state.data_series:
+    for i, s in enumerate(st.session_state.data_series):
         if s.name == s_name:
+            st.session_state.history.record(
+                SeriesListChange(st.session_state.data_series, i, s, added=False)
+            )
             st.session_state.data_series.remove(s)
             break
     if st.session_state.active_series.name == s_name:
@@ -278,11 +382,17 @@ def delete_series(s_name: str):
             st.session_state.active_series = None
 
 
-def update_fit(series: DataSeries, fit_type: str, show_fit: bool):
+fit_fields = ["attempt_plot", "fit_params", "r_squared", "fit_type", "show"]
+
+
+def update_fit(series: DataSeries, fit_type: str, show_fit: bool, record: bool = True) -> FieldsChange:
+    old = {f: getattr(series.line_of_best_fit, f) for f in fit_fields}
     series.line_of_best_fit.attempt_plot = True
     # fit the data
     try:
-        series.line_of_best_fit.fit_params, series.line_of_best_fit.r_squared = fit(fit_type, series.x, series.y)
+        series.line_of_best_fit.fit_params, series.line_of_best_fit.r_squared = fit(
+            fit_type, series.x, series.y, series.stats
+        )
     except Exception as e:
         st.error(handle_fit_error(e, fit_type, series.name))
         series.line_of_best_fit.attempt_plot = False
@@ -290,60 +400,112 @@ def update_fit(series: DataSeries, fit_type: str, show_fit: bool):
     series.line_of_best_fit.fit_type = fit_type
     # update showing
     series.line_of_best_fit.show = show_fit
+    change = FieldsChange(
+        series.line_of_best_fit,
+        old,
+        {f: getattr(series.line_of_best_fit, f) for f in fit_fields},
+        ["show_line_of_best_fit", "fit_type"],
+    )
+    if record:
+        st.session_state.history.record(change)
+    return change
 
 
-def update_data(series: DataSeries, key: str):
-    # has format {"edited_rows": {row: {column: value}}}
-    # will only ever have one row and one column
-    changed = st.session_state[key]
-    for row, ch in changed["edited_rows"].items():
-        for column, value in ch.items():
-            if column == "0":
-                try:
-                    if value is None:
-                        series.x[row] = 0
-                    else:
-                        series.x[row] = float(value)
-                except Exception as e:
-                    st.error("The data must be numeric.")
-                    return
-            elif column == "1":
-                try:
-                    if value is None:
-                        series.y[row] = 0
-                    else:
-                        series.y[row] = float(value)
-                except Exception as e:
-                    st.error("The data must be numeric.")
-                    return
-            else:
-                raise ValueError(f"Invalid column index: {column}")
-    to_remove = changed["deleted_rows"]
-    # sort reversed so that the indices don't change
-    to_remove.sort(reverse=True)
-    for row in to_remove:
-        series.x = np.delete(series.x, row)
-        series.y = np.delete(series.y, row)
-    for row in changed["added_rows"]:
-        # added rows are always at the end
-        if "0" not in row:
-            series.x = np.append(series.x, 0)
-        else:
-            series.x = np.append(series.x, float(row["0"]))
-        if "1" not in row:
-            series.y = np.append(series.y, 0)
-        else:
-            series.y = np.append(series.y, float(row["1"]))
-    update_fit(series, series.line_of_best_fit.fit_type, series.line_of_best_fit.show)
+def update_data(series: DataSeries, key: str, offset: int = 0):
+    # the whole batch of edits is converted and checked first, then applied at once, with a single refit.
+    # offset is the first row of the page shown in the editor.
+    try:
+        changes = EditorChanges.from_state(st.session_state[key], len(series), offset)
+    except NumericParseError as e:
+        st.error(f"`{e.token}` in row {e.line} is not a number. The data must be numeric.")
+        return
+    except Exception as e:
+        st.error("The data must be numeric.")
+        logging.error(f"Invalid edit to {series.name}: {e}")
+        return
+    cell_old, deleted_values = series.apply_changes(changes)
+    # only the cells and rows being changed are kept for undo, not the whole series
+    rows_change = RowsChange(
+        series,
+        changes.cell_rows,
+        changes.cell_columns,
+        cell_old,
+        changes.cell_values,
+        changes.deleted_rows,
+        deleted_values,
+        changes.added,
+        [key],
+    )
+    fit_change = update_fit(series, series.line_of_best_fit.fit_type, series.line_of_best_fit.show, record=False)
+    st.session_state.history.record(CompoundChange([rows_change, fit_change]))
+
+
+# the data editor only ever holds this many rows, however long the series is
+editor_page_rows = 500
+
+
+def editor_start(series: DataSeries) -> int:
+    # the first row of the page of the series being edited
+    start = st.session_state.get(f"{series.name}_first_row", 0)
+    return max(0, min(start, len(series) - 1))
+
+
+def editor_key(series: DataSeries) -> str:
+    # each page is a separate widget, so that edits on one page are never applied to another
+    return f"{series.name}_data_{editor_start(series)}"
+
+
+def data_editor(series: DataSeries):
+    # A windowed editor: only one page of rows is sent to the browser. Row numbers in the editor's edits are
+    # relative to the page, and are mapped back to rows of the series in update_data.
+    if len(series) > editor_page_rows:
+        first, info = st.columns(2)
+        first.number_input(
+            "First Row",
+            min_value=0,
+            max_value=len(series) - 1,
+            value=0,
+            step=editor_page_rows,
+            key=f"{series.name}_first_row",
+            help=f"Jump to any row. The data is shown {editor_page_rows} rows at a time.",
+        )
+    start = editor_start(series)
+    stop = min(start + editor_page_rows, len(series))
+    if len(series) > editor_page_rows:
+        info.caption(f"Showing rows {start} to {stop - 1} of {len(series)}. New rows are added to the end of the series.")
+    st.data_editor(
+        pd.DataFrame(series.data[start:stop], columns=["0", "1"], index=pd.RangeIndex(start, stop)),
+        use_container_width=True,
+        key=editor_key(series),
+        on_change=update_data,
+        args=(series, editor_key(series), start),
+        column_config={"0": "x", "1": "y"},
+        num_rows="dynamic",
+    )
+
+
+def reset_data(series: DataSeries):
+    old = series.buffer
+    series.reset_data()
+    fit_change = update_fit(series, series.line_of_best_fit.fit_type, series.line_of_best_fit.show, record=False)
+    st.session_state.history.record(
+        CompoundChange(
+            [FieldsChange(series, {"buffer": old}, {"buffer": series.buffer}, [editor_key(series)]), fit_change]
+        )
+    )
 
 
 # plot
 @st.cache_data
-def plot(data_series, figure_properties):
+def plot(fingerprint: str, _data_series, _figure_properties):
+    # The figure is cached against the fingerprint of the state alone. The data series and figure properties
+    # themselves start with underscores so that st.cache_data doesn't hash them, which would mean reading all
+    # of the data on every rerun.
+    data_series, figure_properties = _data_series, _figure_properties
     fig, ax = plt.subplots()
     for s in data_series:
-        x_data = s.x
-        y_data = s.y
+        # large series are decimated, since there's no point drawing more points than the figure has pixels
+        x_data, y_data = s.plot_data()
         legend = {}
         if s.legend_entry.show:
             legend["label"] = process_units(s.legend_entry.label)
@@ -380,7 +542,7 @@ def plot(data_series, figure_properties):
         if not s.line_of_best_fit.show:
             continue
 
-        x_temp = np.linspace(x_data.min(), x_data.max(), max(100, len(x_data)))
+        x_temp = np.linspace(s.stats.x_min, s.stats.x_max, max(100, len(x_data)))
         y_temp = get_fitted_data(
             x_temp,
             s.line_of_best_fit.fit_type,
@@ -512,6 +674,14 @@ def get_confirmation(
             else:
                 st.rerun()
 
+def describe_revision(revision: dict) -> str:
+    # e.g. "2024-01-01 12:00:00: title text, marker size"
+    changes = dict.fromkeys(
+        " ".join([p for p in path if isinstance(p, str) and p not in ("figure_properties", "data_series")][-2:]).replace("_", " ")
+        for path in revision["paths"]
+    )
+    return f"{revision['time'][:19]}: {', '.join(changes)}"
+
 def score_sidebar(percent_score, score_color):
     st.sidebar.header("Mark My Graph")
     st.sidebar.markdown(f"""<div style = "display: flex; align-items: center; justify-content: center;">
@@ -522,12 +692,19 @@ def score_sidebar(percent_score, score_color):
 </div>""", unsafe_allow_html=True)
     st.sidebar.divider()
 
+# the figure was saved from somewhere else (e.g. another tab) after it was loaded here, so the changes made here
+# since weren't saved over it
+if take_conflict(tab_save_state()):
+    st.warning("This figure was changed in another window or tab, so it has been reloaded with those changes. Your latest changes here couldn't be saved.")
+    st.session_state.should_load = True
+
 if st.session_state.should_load:
     try:
-        _data_series, _figure_properties, _csv_file = load_data(st.session_state.cookie_key)
+        _data_series, _figure_properties, _csv_file = load_data(st.session_state.cookie_key, save_state=tab_save_state())
         st.session_state.data_series = _data_series
         st.session_state.figure_properties = _figure_properties
         st.session_state.csv_file = _csv_file
+        st.session_state.history = History()
         st.session_state.should_load = False
     except Exception as e:
         st.error("There was an error loading the data from the server. This is likely due to a server error or an outdated data format. Please start a new figure as normal.")
@@ -542,8 +719,22 @@ if "data_series" not in st.session_state:
     st.session_state.data_series = []
 if "csv_file" not in st.session_state:
     st.session_state.csv_file = None
+if "history" not in st.session_state:
+    st.session_state.history = History()
+if "imported_table" not in st.session_state:
+    st.session_state.imported_table = None
 if "try_parse_csv" not in st.session_state:
     st.session_state.try_parse_csv = False
+# Other pages only load the data when it's used (see load_data). Everything is needed here, so read it all in
+# now; if the saved session has changed since, start again from the latest version.
+try:
+    for series in st.session_state.data_series:
+        series.load()
+    if st.session_state.csv_file is not None:
+        st.session_state.csv_file.load()
+except StaleSessionError:
+    st.session_state.should_load = True
+    st.rerun()
 # Sidebar -------------------------------------
 
 
@@ -637,23 +828,24 @@ def marker_options():
         st.session_state.active_series.marker.color,
         "marker_auto_color",
         "marker_color",
-        auto_callback=lambda: setattr(
+        auto_callback=lambda: set_property(
             st.session_state.active_series.marker.color,
             "auto_color",
-            st.session_state.marker_auto_color,
+            "marker_auto_color",
         ),
-        colour_callback=lambda: setattr(
+        colour_callback=lambda: set_property(
             st.session_state.active_series.marker.color,
             "color",
-            st.session_state.marker_color,
+            "marker_color",
         ),
         show_opacity=True,
         always_show_opacity=True,
         opacity_key="marker_opacity",
-        opacity_callback=lambda: setattr(
+        opacity_callback=lambda: set_property(
             st.session_state.active_series.marker.color,
             "opacity",
-            st.session_state.marker_opacity / 100,
+            "marker_opacity",
+            convert=from_percent,
         ),
     )
     # marker size
@@ -664,10 +856,10 @@ def marker_options():
         float(st.session_state.active_series.marker.size),
         step=0.2,
         key="marker_size",
-        on_change=lambda: setattr(
+        on_change=lambda: set_property(
             st.session_state.active_series.marker,
             "size",
-            st.session_state.marker_size,
+            "marker_size",
         ),
     )
 
@@ -687,10 +879,10 @@ def line_options(
         key=style_key,
         format_func=lambda x: x.name.replace("_", " ").title(),
         index=line.style.index,
-        on_change=lambda: setattr(
+        on_change=lambda: set_property(
             line,
             "style",
-            st.session_state[style_key],
+            style_key,
         ),
     )
     if st.session_state[style_key] != LineStyles.NONE:
@@ -699,23 +891,24 @@ def line_options(
             line.color,
             auto_key,
             colour_key,
-            auto_callback=lambda: setattr(
+            auto_callback=lambda: set_property(
                 line.color,
                 "auto_color",
-                st.session_state[auto_key],
+                auto_key,
             ),
-            colour_callback=lambda: setattr(
+            colour_callback=lambda: set_property(
                 line.color,
                 "color",
-                st.session_state[colour_key],
+                colour_key,
             ),
             show_opacity=True,
             always_show_opacity=True,
             opacity_key=opacity_key,
-            opacity_callback=lambda: setattr(
+            opacity_callback=lambda: set_property(
                 line.color,
                 "opacity",
-                st.session_state[opacity_key] / 100,
+                opacity_key,
+                convert=from_percent,
             ),
         )
         # line width
@@ -726,10 +919,10 @@ def line_options(
             float(line.width),
             step=0.1,
             key=width_key,
-            on_change=lambda: setattr(
+            on_change=lambda: set_property(
                 line,
                 "width",
-                st.session_state[width_key],
+                width_key,
             ),
         )
 
@@ -743,8 +936,8 @@ def data_series_options():
             key="marker",
             format_func=lambda x: x.name.replace("_", " ").title(),
             index=st.session_state.active_series.marker.style.index,
-            on_change=lambda: setattr(
-                st.session_state.active_series.marker, "style", st.session_state.marker
+            on_change=lambda: set_property(
+                st.session_state.active_series.marker, "style", "marker"
             ),
         )
         if marker_style != MarkerStyles.NONE:
@@ -765,10 +958,10 @@ def data_series_options():
             "Show in Legend",
             True,
             key="show_in_legend",
-            on_change=lambda: setattr(
+            on_change=lambda: set_property(
                 st.session_state.active_series.legend_entry,
                 "show",
-                st.session_state.show_in_legend,
+                "show_in_legend",
             ),
         )
         # label
@@ -777,10 +970,10 @@ def data_series_options():
                 "Legend Label",
                 st.session_state.active_series.legend_entry.label,
                 key="legend_label",
-                on_change=lambda: setattr(
+                on_change=lambda: set_property(
                     st.session_state.active_series.legend_entry,
                     "label",
-                    st.session_state.legend_label,
+                    "legend_label",
                 ),
             )
 
@@ -811,20 +1004,23 @@ def text_options(
     )
 
 
+fit_types = [
+    "Linear",
+    "Quadratic",
+    "Cubic",
+    "Exponential",
+    "Logarithmic",
+    "Sinusoidal",
+]
+
+
 def line_of_best_fit_options():
     with st.sidebar.expander("**Line of Best Fit**", expanded=False):
         st.subheader("Fit")
         # fit type
         st.selectbox(
             "Fit Type",
-            [
-                "Linear",
-                "Quadratic",
-                "Cubic",
-                "Exponential",
-                "Logarithmic",
-                "Sinusoidal",
-            ],
+            fit_types,
             key="fit_type",
             index=0,
             on_change=lambda: update_fit(
@@ -882,10 +1078,10 @@ def line_of_best_fit_options():
             "Show in Legend",
             st.session_state.active_series.line_of_best_fit.legend_entry.show,
             key="show_line_of_best_fit_in_legend",
-            on_change=lambda: setattr(
+            on_change=lambda: set_property(
                 st.session_state.active_series.line_of_best_fit.legend_entry,
                 "show",
-                st.session_state.show_line_of_best_fit_in_legend,
+                "show_line_of_best_fit_in_legend",
             ),
         )
         if st.session_state.show_line_of_best_fit_in_legend:
@@ -894,10 +1090,10 @@ def line_of_best_fit_options():
                 "Legend Label",
                 st.session_state.active_series.line_of_best_fit.legend_entry.label,
                 key="line_of_best_fit_legend_label",
-                on_change=lambda: setattr(
+                on_change=lambda: set_property(
                     st.session_state.active_series.line_of_best_fit.legend_entry,
                     "label",
-                    st.session_state.line_of_best_fit_legend_label,
+                    "line_of_best_fit_legend_label",
                 ),
             )
 
@@ -934,7 +1130,9 @@ def axis_options(
             help="Leave blank for automatic scaling.",
         )
         axis_lim = None if len(axis_lim.strip()) == 0 else float(axis_lim)
-        axis.min = axis_lim
+        if axis_lim != axis.min:
+            st.session_state.history.record(FieldsChange(axis, {"min": axis.min}, {"min": axis_lim}, [key]))
+            axis.min = axis_lim
     with max_col:
         key = f"{axis_name}_max"
         axis_lim = st.text_input(
@@ -945,22 +1143,24 @@ def axis_options(
         )
         
         axis_lim = None if len(axis_lim.strip()) == 0 else float(axis_lim)
-        axis.max = axis_lim
+        if axis_lim != axis.max:
+            st.session_state.history.record(FieldsChange(axis, {"max": axis.max}, {"max": axis_lim}, [key]))
+            axis.max = axis_lim
     text_options(
         f"${axis_name}$ Axis Label",
         axis.label,
         axis.font_size,
         f"{axis_name}_label",
         f"font_size_{axis_name}",
-        text_callback=lambda: setattr(
+        text_callback=lambda: set_property(
             axis,
             "label",
-            st.session_state[f"{axis_name}_label"],
+            f"{axis_name}_label",
         ),
-        font_size_callback=lambda: setattr(
+        font_size_callback=lambda: set_property(
             axis,
             "font_size",
-            st.session_state[f"font_size_{axis_name}"],
+            f"font_size_{axis_name}",
         ),
     )
 
@@ -983,15 +1183,15 @@ def figure_sidebar():
             st.session_state.figure_properties.title.font_size,
             "title",
             "font_size_title",
-            text_callback=lambda: setattr(
+            text_callback=lambda: set_property(
                 st.session_state.figure_properties.title,
                 "text",
-                st.session_state.title,
+                "title",
             ),
-            font_size_callback=lambda: setattr(
+            font_size_callback=lambda: set_property(
                 st.session_state.figure_properties.title,
                 "font_size",
-                st.session_state.font_size_title,
+                "font_size_title",
             ),
         )
     with st.sidebar.expander("**Legend**"):
@@ -999,10 +1199,10 @@ def figure_sidebar():
             "Show Legend", 
             st.session_state.figure_properties.legend.show, 
             key="show_legend",
-            on_change=lambda: setattr(
+            on_change=lambda: set_property(
                 st.session_state.figure_properties.legend,
                 "show",
-                st.session_state.show_legend,
+                "show_legend",
             ),
         )
         if show_legend:
@@ -1026,10 +1226,10 @@ def figure_sidebar():
                 index=positions.index(
                     st.session_state.figure_properties.legend.position
                 ),
-                on_change=lambda: setattr(
+                on_change=lambda: set_property(
                     st.session_state.figure_properties.legend,
                     "position",
-                    st.session_state.legend_position,
+                    "legend_position",
                 ),
             )
             # font size
@@ -1039,10 +1239,10 @@ def figure_sidebar():
                 32,
                 int(st.session_state.figure_properties.legend.font_size),
                 key="font_size_legend",
-                on_change=lambda: setattr(
+                on_change=lambda: set_property(
                     st.session_state.figure_properties.legend,
                     "font_size",
-                    st.session_state.font_size_legend,
+                    "font_size_legend",
                 ),
             )
             colour_choice(
@@ -1050,22 +1250,23 @@ def figure_sidebar():
                 st.session_state.figure_properties.legend.background_color,
                 "legend_auto_color",
                 "legend_background_color",
-                auto_callback=lambda: setattr(
+                auto_callback=lambda: set_property(
                     st.session_state.figure_properties.legend.background_color,
                     "auto_color",
-                    st.session_state.legend_auto_color,
+                    "legend_auto_color",
                 ),
-                colour_callback=lambda: setattr(
+                colour_callback=lambda: set_property(
                     st.session_state.figure_properties.legend.background_color,
                     "color",
-                    st.session_state.legend_background_color,
+                    "legend_background_color",
                 ),
                 show_opacity=True,
                 opacity_key="legend_opacity",
-                opacity_callback=lambda: setattr(
+                opacity_callback=lambda: set_property(
                     st.session_state.figure_properties.legend.background_color,
                     "opacity",
-                    st.session_state.legend_opacity / 100,
+                    "legend_opacity",
+                    convert=from_percent,
                 ),
             )
 
@@ -1110,10 +1311,10 @@ def figure_sidebar():
         themes,
         index=themes.index(st.session_state.figure_properties.theme),
         key="theme",
-        on_change=lambda: setattr(
+        on_change=lambda: set_property(
             st.session_state.figure_properties,
             "theme",
-            st.session_state.theme,
+            "theme",
         ),
     )
 
@@ -1131,10 +1332,11 @@ def file_sidebar():
         formats,
         key="file_format",
         index=formats.index(st.session_state.figure_properties.file_type.upper()),
-        on_change=lambda: setattr(
+        on_change=lambda: set_property(
             st.session_state.figure_properties,
             "file_type",
-            st.session_state.file_format.upper(),
+            "file_format",
+            convert=str.upper,
         ),
     )
 
@@ -1144,16 +1346,21 @@ def file_sidebar():
         st.session_state.figure_properties.filename,
         key="file_name",
         help="Do not include the file extension.",
-        on_change=lambda: setattr(
+        on_change=lambda: set_property(
             st.session_state.figure_properties,
             "filename",
-            st.session_state.file_name,
+            "file_name",
         ),
     )
 
 
 if len(st.session_state.data_series) > 0:
-    score, color = check_for_problems(score_only = True)
+    # only re-mark the figure if something has changed since it was last marked
+    version = state_version(st.session_state.data_series, st.session_state.figure_properties)
+    if st.session_state.get("score_version") != version:
+        st.session_state.score = check_for_problems(score_only = True)
+        st.session_state.score_version = version
+    score, color = st.session_state.score
     score_sidebar(score, color)
 
 st.sidebar.title("Options")
@@ -1171,10 +1378,212 @@ else:
 
 # Main ----------------------------------------
 
+csv_preview_rows = 100
+
+
+def csv_batch_options(x_col: str, numeric_data: np.array, summary: pd.DataFrame):
+    # add several y columns against the same x column in one action, using the columns already parsed for this rerun
+    st.markdown("**Add Several Series**")
+    numeric_columns = [c for c in summary.index if summary["Numeric"][c] == 1 and c != x_col]
+    y_cols = st.multiselect(
+        "Y Columns",
+        numeric_columns,
+        key="csv_y_cols",
+        help="Each selected column is added as its own data series, all using the $x$ column chosen above.",
+    )
+    left, right = st.columns(2)
+    with left:
+        fit_type = st.selectbox(
+            "Line of Best Fit",
+            ["None"] + fit_types,
+            key="csv_batch_fit_type",
+        )
+    with right:
+        # line the button up with the select box
+        st.write("")
+        st.button(
+            f"Add {len(y_cols)} Series",
+            key="add_csv_columns",
+            disabled=len(y_cols) == 0 or summary["Numeric"][x_col] != 1,
+            on_click=add_many_series,
+            args=(
+                numeric_data[:, int(x_col)],
+                {f"Column {c}": numeric_data[:, int(c)] for c in y_cols},
+                fit_type,
+            ),
+            use_container_width=True,
+        )
+
+
+def csv_preview(csv_file: CSVFile, x_col: str, y_col: str, summary: pd.DataFrame):
+    # only a window of rows is styled and sent to the browser, since the full table can be very large
+    with st.expander("Column Summary", expanded=False):
+        st.dataframe(
+            summary,
+            use_container_width=True,
+            column_config={
+                "Numeric": st.column_config.ProgressColumn(
+                    "Numeric", min_value=0, max_value=1, format="%.2f"
+                ),
+            },
+        )
+    num_rows = len(csv_file.data)
+    num_pages = max(1, (num_rows + csv_preview_rows - 1) // csv_preview_rows)
+    left, right = st.columns(2)
+    with left:
+        window = st.radio(
+            "Preview",
+            ["Head", "Tail", "Page"],
+            key="csv_preview_window",
+            horizontal=True,
+        )
+    match window:
+        case "Head":
+            start = 0
+        case "Tail":
+            start = max(0, num_rows - csv_preview_rows)
+        case _:
+            with right:
+                page = st.number_input(
+                    f"Page (of {num_pages})",
+                    min_value=1,
+                    max_value=num_pages,
+                    value=1,
+                    key="csv_preview_page",
+                )
+            start = (page - 1) * csv_preview_rows
+    stop = min(num_rows, start + csv_preview_rows)
+    data_window = pd.DataFrame(
+        csv_file.data[start:stop],
+        index=range(start, stop),
+        columns=[str(i) for i in range(csv_file.data.shape[1])],
+    )
+    # highlight whole columns at once rather than styling row by row
+    data_styled = data_window.style.set_properties(
+        subset=[y_col], **{"background-color": "#bfd1ff"}
+    ).set_properties(subset=[x_col], **{"background-color": "#ffb5b5"})
+    st.dataframe(
+        data_styled,
+        use_container_width=True,
+        column_config={
+            str(x_col): "X Column",
+            str(y_col): "Y Column",
+        },
+    )
+    st.caption(f"Showing rows {start} to {stop - 1} of {num_rows}.")
+
+
+def load_upload(uploaded_file, member: str = None):
+    # work out the real file type once any compression is removed, and load it as either a CSV file or an imported table
+    if member is not None:
+        name = member
+    elif is_compressed(uploaded_file.name):
+        name = inner_name(uploaded_file.name)
+    else:
+        name = uploaded_file.name
+    compressed = is_compressed(uploaded_file.name)
+    try:
+        if can_import(name):
+            # the importer reads straight from the uploaded buffer, without converting to text
+            if compressed:
+                buffer = decompress_bytes(uploaded_file.name, uploaded_file, member)
+            else:
+                buffer = uploaded_file.getbuffer()
+            st.session_state.imported_table = import_file(name, buffer)
+        else:
+            if compressed:
+                csv_contents = decompress_text(uploaded_file.name, uploaded_file, member)
+            else:
+                csv_contents = uploaded_file.getvalue().decode("utf-8")
+            st.session_state.csv_file = CSVFile(csv_contents)
+            st.session_state.try_parse_csv = True
+    except Exception as e:
+        logging.error(e)
+        st.error(handle_import_error(e, name))
+        return
+    st.rerun()
+
+
+def add_imported_data(table: ColumnTable):
+    # only the two selected columns are read from the file
+    x_col = st.session_state.imported_x_col
+    y_col = st.session_state.imported_y_col
+    name = st.session_state.imported_name
+    try:
+        columns = table.read([x_col, y_col])
+    except Exception as e:
+        logging.error(e)
+        st.error(handle_import_error(e, table.name))
+        return
+    add_new_data(name, columns[x_col], columns[y_col])
+
+
+def imported_table_options(table: ColumnTable):
+    st.markdown(f"Imported `{table.name}`, which has {len(table)} column{'s' if len(table) != 1 else ''}.")
+    left, right = st.columns(2)
+    with left:
+        st.selectbox(
+            "X Column",
+            table.columns,
+            key="imported_x_col",
+            index=0,
+            help="The column to use for the $x$-data.",
+        )
+    with right:
+        st.selectbox(
+            "Y Column",
+            table.columns,
+            key="imported_y_col",
+            index=min(1, len(table) - 1),
+            help="The column to use for the $y$-data.",
+        )
+    with left:
+        st.text_input(
+            "Name",
+            f"Data Series {len(st.session_state.data_series) + 1}",
+            key="imported_name",
+        )
+    st.divider()
+    left, right = st.columns(2)
+    with left:
+        st.button(
+            "Add Data",
+            key="add_imported_data",
+            on_click=add_imported_data,
+            args=(table,),
+            use_container_width=True,
+        )
+    with right:
+        st.button(
+            "Clear File",
+            key="clear_imported",
+            type="primary",
+            on_click=lambda: setattr(st.session_state, "imported_table", None),
+            help="Clear the current file, so that another might be uploaded.",
+            use_container_width=True,
+        )
+
+
 def main_panes():
     plot_col, data_col = st.columns([0.6, 0.4])
 
     plot_col.header("Plot")
+    with plot_col:
+        undo_col, redo_col, _ = st.columns([1, 1, 4])
+        undo_col.button(
+            "↩️ Undo",
+            key="undo",
+            on_click=undo,
+            disabled=not st.session_state.history.can_undo,
+            use_container_width=True,
+        )
+        redo_col.button(
+            "↪️ Redo",
+            key="redo",
+            on_click=redo,
+            disabled=not st.session_state.history.can_redo,
+            use_container_width=True,
+        )
 
     data_col.header("Data")
 
@@ -1196,20 +1605,14 @@ def main_panes():
                             "Name",
                             s.name,
                             key=f"{s.name}_name",
-                            on_change=lambda: setattr(
-                                s, "name", st.session_state[f"{s.name}_name"]
-                            ),
-                        )
-                        data = np.array([s.x, s.y]).T
-                        st.data_editor(
-                            data,
-                            use_container_width=True,
-                            key=f"{s.name}_data",
-                            on_change=update_data,
-                            args=(s, f"{s.name}_data"),
-                            column_config={"0": "x", "1": "y"},
-                            num_rows="dynamic",
+                            on_change=set_property,
+                            args=(s, "name", f"{s.name}_name"),
                         )
+                        # only the active series gets an editor straight away; the others wait until asked for
+                        if s is st.session_state.active_series or st.toggle(
+                            "Edit Data", key=f"{s.name}_edit"
+                        ):
+                            data_editor(s)
                         left, right = st.columns(2)
                         with left:
                             # Delete button
@@ -1219,13 +1622,13 @@ def main_panes():
                                 type="primary",
                                 on_click=confirm,
                                 args=(
-                                    "Are you sure you want to delete this data series? :red[This cannot be undone].",
+                                    "Are you sure you want to delete this data series? You can undo this with the Undo button above the plot.",
                                     lambda: delete_series(s.name),
                                     None,
                                     "Delete",
                                     "Cancel",
                                 ),
-                                help="Delete the **entire** data series. :red[This cannot be undone].",
+                                help="Delete the **entire** data series.",
                             )
                             
                         with right:
@@ -1235,13 +1638,13 @@ def main_panes():
                                 key=f"{s.name}_reset",
                                 on_click=confirm,
                                 args=(
-                                    "Are you sure you want to reset this data series? All changes will be lost. :red[This cannot be undone].",
-                                    lambda: s.reset_data(),
+                                    "Are you sure you want to reset this data series? All changes will be lost, unless undone.",
+                                    lambda: reset_data(s),
                                     None,
                                     "Reset",
                                     "Cancel",
                                 ),
-                                help="Reset the data to the original values. :red[This cannot be undone].",
+                                help="Reset the data to the original values.",
                             )
         with new_data:
             # new data name
@@ -1268,20 +1671,34 @@ def main_panes():
             # add button
             st.button("Add Data", key="add_data", on_click=add_new_data)
         with from_csv:
-            if st.session_state.csv_file is None:
+            if st.session_state.imported_table is not None:
+                imported_table_options(st.session_state.imported_table)
+            elif st.session_state.csv_file is None:
                 # upload csv
-                st.markdown("Upload a CSV file to add data.")
+                st.markdown("Upload a CSV file to add data. NumPy, Parquet, HDF5 and Arrow files can also be imported directly, and any of these can be compressed.")
                 csv_file = st.file_uploader(
                     "Upload CSV",
-                    type=["csv", "tsv", "txt"],
+                    type=["csv", "tsv", "txt"]
+                    + [ext[1:] for ext in importers]
+                    + [ext[1:] for ext in compressed_types],
                     key="upload_csv",
                     help="Upload a CSV file to add data.",
                 )
-                if csv_file is not None:
-                    csv_contents = csv_file.getvalue().decode("utf-8")
-                    st.session_state.csv_file = CSVFile(csv_contents)
-                    st.session_state.try_parse_csv = True
-                    st.rerun()
+                if csv_file is not None and is_archive(csv_file.name):
+                    members = archive_members(csv_file)
+                    if len(members) == 1:
+                        load_upload(csv_file, members[0])
+                    else:
+                        st.selectbox(
+                            "File",
+                            members,
+                            key="archive_member",
+                            help="Choose which file to load from the archive. Only this file will be extracted.",
+                        )
+                        if st.button("Load File", key="load_archive_member"):
+                            load_upload(csv_file, st.session_state.archive_member)
+                elif csv_file is not None:
+                    load_upload(csv_file)
             else:
                 csv_file = st.session_state.csv_file
                 if st.session_state.try_parse_csv:
@@ -1354,15 +1771,8 @@ def main_panes():
                             ),
                         )
                 try:
-                    data = np.genfromtxt(
-                        csv_file.contents.split("\n"),
-                        delimiter=csv_file.delimiter.value,
-                        skip_header=csv_file.header_rows,
-                        skip_footer=csv_file.footer_rows,
-                        comments=csv_file.comment_character.value,
-                        dtype = str # we'll convert to float later, but some columns might not be numeric
-                    )
-                    csv_file.data = data
+                    # only parsed again when the options change, and reused from the blob store if another session has parsed it
+                    data = parse_csv(csv_file)
                     # check that the data is 2D. If not, we've definitely got a problem
                     if len(data.shape) != 2:
                         err_message = "The csv file did not produce a 2D table of data. This is likely not the correct delimiter. Your uploaded file is shown below for reference."
@@ -1402,18 +1812,15 @@ def main_panes():
                                 f"Data Series {len(st.session_state.data_series) + 1}",
                                 key="csv_name",
                             )
-                            new_x_data = csv_file.data[:, int(x_col)]
-                            new_y_data = csv_file.data[:, int(y_col)]
-                            # convert to floats
-                            try:
-                                # let any empty cells be converted to 0
-                                new_x_data = ["0" if len(x.strip()) == 0 else x for x in new_x_data]
-                                new_y_data = ["0" if len(y.strip()) == 0 else y for y in new_y_data]
-                                new_x_data = np.array(new_x_data, dtype=float)
-                                new_y_data = np.array(new_y_data, dtype=float)
-                                show_button = True
-                            except ValueError:
-                                show_button = False
+                            # convert to floats. Any empty cells are converted to 0
+                            numeric_data = csv_file.numeric_data()
+                            summary = csv_file.column_summary()
+                            new_x_data = numeric_data[:, int(x_col)]
+                            new_y_data = numeric_data[:, int(y_col)]
+                            show_button = (
+                                summary["Numeric"][x_col] == 1
+                                and summary["Numeric"][y_col] == 1
+                            )
                     st.divider()
                     left, right = st.columns(2)
                     with left:
@@ -1450,26 +1857,16 @@ def main_panes():
                             help = "Clear the current csv file, so that another might be uploaded.",
                             use_container_width = True
                         )
+                    if csv_file.data is not None:
+                        st.divider()
+                        csv_batch_options(x_col, numeric_data, summary)
                 if csv_file.data is not None:
-                    data_styled = csv_file.data.copy()
-                    # convert to dataframe
-                    data_styled = pd.DataFrame(data_styled)
-                    # style the selected columns
-                    data_styled = data_styled.style.apply(
-                        lambda x: ["background-color: #ffb5b5" if i == int(x_col) else "background-color: #bfd1ff" if i == int(y_col) else "" for i in range(len(x))],
-                        axis=1
-                    )
-                    st.dataframe(
-                        data_styled, 
-                        use_container_width=True,
-                        column_config = {
-                            str(x_col): "X Column",
-                            str(y_col): "Y Column"
-                        },
-                        hide_index=True
-                    )
+                    csv_preview(csv_file, x_col, y_col, summary)
+
 
 
+    if "cookie_key" in st.session_state and st.session_state.cookie_key is not None:
+        spill_large_series(st.session_state.cookie_key, st.session_state.data_series)
 
     if len(st.session_state.data_series) > 0:
         set_theme(st.session_state.theme)
@@ -1482,6 +1879,7 @@ def main_panes():
             if len(st.session_state.data_series) > 0:
                 start = time.perf_counter_ns()
                 svg_data, download_data = plot(
+                    state_fingerprint(st.session_state.data_series, st.session_state.figure_properties),
                     st.session_state.data_series,
                     st.session_state.figure_properties,
                 )
@@ -1509,6 +1907,11 @@ def main_panes():
     st.sidebar.header("Advanced")
 
     if len(st.session_state.data_series) > 0:
+        usage = memory_usage(st.session_state.data_series)
+        st.sidebar.caption(
+            f"Data: {format_bytes(usage['data'])}, plus {format_bytes(usage['original'])} kept for resetting edited series."
+            + (f" {format_bytes(usage['mapped'])} of large series is stored on disk." if usage["mapped"] > 0 else "")
+        )
         json_data = json.dumps(
             {
                 "data_series": [s.to_dict() for s in st.session_state.data_series],
@@ -1531,11 +1934,35 @@ def main_panes():
             on_click=confirm,
             args=(
                 "Are you sure you want to start a new figure? :red[This will clear all current data.]",
-                lambda: clear_data(st.session_state.cookie_key),
+                lambda: clear_data(st.session_state.cookie_key, tab_save_state()),
             ),
             type="primary",
             use_container_width=True,
         )
+        if journal_enabled() and st.sidebar.toggle(
+            "Saved Versions", key="show_revisions", help="Go back to an earlier version of the figure."
+        ):
+            revisions = {r["seq"]: r for r in session_revisions(st.session_state.cookie_key)}
+            if len(revisions) == 0:
+                st.sidebar.caption("There are no earlier versions to go back to yet.")
+            else:
+                revision = st.sidebar.selectbox(
+                    "Version",
+                    list(revisions),
+                    format_func=lambda seq: describe_revision(revisions[seq]),
+                    key="revision",
+                )
+                st.sidebar.button(
+                    "Restore",
+                    key="restore_revision",
+                    help="Go back to this version. The current version is kept, so this can be undone.",
+                    on_click=confirm,
+                    args=(
+                        "Are you sure you want to go back to this version of the figure?",
+                        lambda: restore_revision(st.session_state.cookie_key, revision, tab_save_state()),
+                    ),
+                    use_container_width=True,
+                )
     else:
         # upload data
         uploaded_file = st.sidebar.file_uploader("Upload Data", type=["json"])
@@ -1549,12 +1976,14 @@ def main_panes():
                     data["figure_properties"]
                 )
                 st.session_state.active_series = st.session_state.data_series[0]
+                st.session_state.history.clear()
                 if "cookie_key" in st.session_state:
                     save_data(
                         st.session_state.cookie_key,
                         st.session_state.data_series,
                         st.session_state.figure_properties,
                         st.session_state.csv_file,
+                        tab_save_state(),
                     )
                 st.rerun()
             except Exception as e:
@@ -1567,7 +1996,7 @@ def main_panes():
             on_click=confirm,
             args=(
                 "Are you sure you want to start a new figure? :red[This will clear all current data.]",
-                lambda: clear_data(st.session_state.cookie_key),
+                lambda: clear_data(st.session_state.cookie_key, tab_save_state()),
             ),
             type="primary",
             use_container_width=True,
@@ -1584,8 +2013,9 @@ def main_panes():
                 st.session_state.data_series,
                 st.session_state.figure_properties,
                 st.session_state.csv_file,
+                tab_save_state(),
             )
-    clean_old_files()
+    start_sweeper()
 
 if "getting_confirmation" not in st.session_state:
     st.session_state.getting_confirmation = False
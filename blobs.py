@@ -0,0 +1,160 @@
+import hashlib
+import io
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import time
+
+import numpy as np
+
+from storage import compress, compression_codec, decompress, min_compressed_size, write_atomic
+
+# A content-addressed store for large values shared between sessions, such as uploaded CSV files. Each value is
+# stored once, named by the digest of its contents, however many sessions refer to it, so the same file uploaded
+# by a whole class is only stored once. Things worked out from a value (e.g. a CSV file parsed with particular
+# options) can be stored alongside it as arrays, so that they're only worked out once as well.
+#
+#     ab/abcdef...          the value, compressed, after a 4 byte codec name
+#     ab/abcdef....derived/ arrays worked out from it, as .npy files
+#
+# Values are never changed once written, so they can be shared by every process using the directory. Sessions
+# refer to values by digest; anything no session refers to is removed by sweep. Derived arrays can always be
+# worked out again, so only the max_derived sets most recently used are kept for each value, and sweep removes
+# the least recently used of the rest first when the store is over its size limit.
+
+
+def digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+class BlobStore:
+    def __init__(self, directory: Path, max_derived: int = 4):
+        self.directory = Path(directory)
+        self.max_derived = max_derived
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        if len(key) != 64 or not all(c in "0123456789abcdef" for c in key):
+            raise ValueError(f"Invalid blob key: {key}")
+        return self.directory / key[:2] / key
+
+    def _derived_dir(self, key: str) -> Path:
+        return self._path(key).with_name(f"{key}.derived")
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def put(self, data: bytes, key: str = None) -> str:
+        # stores data, unless it's already there, and returns its key. key saves working out the digest again,
+        # if it's already known.
+        key = digest(data) if key is None else key
+        path = self._path(key)
+        if path.exists():
+            # refreshed, so that sweep knows it's still being used
+            os.utime(path)
+            return key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        codec = compression_codec if len(data) >= min_compressed_size else "none"
+        write_atomic(path, codec.encode("ascii").ljust(4) + compress(data, codec))
+        return key
+
+    def get(self, key: str) -> bytes:
+        raw = self._path(key).read_bytes()
+        return decompress(memoryview(raw)[4:], raw[:4].decode("ascii").strip())
+
+    @staticmethod
+    def _options_name(options) -> str:
+        return hashlib.blake2b(json.dumps(options).encode("utf-8"), digest_size=16).hexdigest()
+
+    def put_arrays(self, key: str, options, arrays: dict):
+        # arrays (name -> array) worked out from the value with the given options (anything JSON can encode)
+        directory = self._derived_dir(key)
+        directory.mkdir(parents=True, exist_ok=True)
+        prefix = self._options_name(options)
+        for name, array in arrays.items():
+            buffer = io.BytesIO()
+            np.save(buffer, array, allow_pickle=False)
+            write_atomic(directory / f"{prefix}.{name}.npy", buffer.getvalue())
+
+    def get_arrays(self, key: str, options, names: list) -> dict | None:
+        # the arrays stored by put_arrays, or None if they haven't all been stored
+        directory = self._derived_dir(key)
+        prefix = self._options_name(options)
+        try:
+            arrays = {name: np.load(directory / f"{prefix}.{name}.npy", allow_pickle=False) for name in names}
+            for name in names:
+                # refreshed, so that sweep knows they're still being used
+                os.utime(directory / f"{prefix}.{name}.npy")
+        except (FileNotFoundError, ValueError):
+            return None
+        return arrays
+
+    @staticmethod
+    def _derived_sets(directory: Path) -> list:
+        # the sets of arrays in a derived directory, as (last used, bytes, paths), most recently used first
+        sets = {}
+        for path in directory.iterdir():
+            if path.name.startswith("."):
+                # still being written (see write_atomic)
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            used, nbytes, paths = sets.get(path.name.split(".")[0], (0, 0, []))
+            sets[path.name.split(".")[0]] = (max(used, stat.st_mtime), nbytes + stat.st_size, paths + [path])
+        return sorted(sets.values(), key=lambda s: s[0], reverse=True)
+
+    def sweep(self, live: set, grace: float = 24 * 60 * 60, max_bytes: int = None) -> int:
+        # Removes every value which isn't in live (the keys still referred to), along with anything derived from
+        # it. Values written in the last grace seconds are kept, since they may belong to a session which hasn't
+        # been saved yet. Then, if the store takes up more than max_bytes, derived arrays are removed, least
+        # recently used first, until it doesn't. Returns the number of values removed.
+        removed = 0
+        cutoff = time.time() - grace
+        nbytes = 0
+        derived = []
+        for shard in self.directory.iterdir():
+            if not shard.is_dir():
+                continue
+            for path in shard.iterdir():
+                key = path.name.removesuffix(".derived")
+                try:
+                    if key in live or path.stat().st_mtime > cutoff:
+                        nbytes += self._count(path, derived)
+                        continue
+                    if path.is_dir():
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        path.unlink(missing_ok=True)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        if removed > 0:
+            logging.info(f"Removed {removed} unused blobs")
+        nbytes += sum(s[1] for s in derived)
+        if max_bytes is not None and nbytes > max_bytes:
+            trimmed = 0
+            for _, set_bytes, paths in sorted(derived, key=lambda s: s[0]):
+                if nbytes <= max_bytes:
+                    break
+                for path in paths:
+                    path.unlink(missing_ok=True)
+                nbytes -= set_bytes
+                trimmed += 1
+            logging.info(f"Removed {trimmed} sets of derived arrays to keep the blob store under {max_bytes} bytes")
+        return removed
+
+    def _count(self, path: Path, derived: list) -> int:
+        # For sweep, a value or derived directory which is being kept. The derived sets beyond the max_derived
+        # most recently used are removed, and the rest are added to derived. Returns the bytes of a value.
+        if not path.is_dir():
+            return path.stat().st_size
+        sets = self._derived_sets(path)
+        for _, _, paths in sets[self.max_derived :]:
+            for p in paths:
+                p.unlink(missing_ok=True)
+        derived.extend(sets[: self.max_derived])
+        return 0
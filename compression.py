@@ -0,0 +1,103 @@
+import bz2
+import codecs
+import gzip
+import lzma
+from io import StringIO
+from pathlib import PurePath
+from typing import BinaryIO, List
+import zipfile
+
+# Read compressed uploads (.gz, .bz2, .xz, .zst and .zip) as a stream. The decompressed bytes are only
+# ever held one chunk at a time, so peak memory is the decoded text plus a single chunk, rather than the
+# whole decompressed file as well.
+
+chunk_size = 1 << 20  # 1 MiB
+# refuse to decompress anything larger than this, so that a tiny upload can't fill the server's memory
+max_decompressed_size = 512 * (1 << 20)
+
+compressed_types = {
+    ".gz": "gzip",
+    ".bz2": "bz2",
+    ".xz": "xz",
+    ".zst": "zstd",
+    ".zip": "zip",
+}
+
+
+def is_compressed(filename: str) -> bool:
+    return PurePath(filename).suffix.lower() in compressed_types
+
+
+def is_archive(filename: str) -> bool:
+    return compressed_types.get(PurePath(filename).suffix.lower()) == "zip"
+
+
+def inner_name(filename: str) -> str:
+    # the name of the file once decompressed, e.g. "data.csv.gz" -> "data.csv"
+    path = PurePath(filename)
+    if path.suffix.lower() in compressed_types:
+        return path.stem
+    return path.name
+
+
+def archive_members(fileobj: BinaryIO) -> List[str]:
+    # only the central directory at the end of the archive is read, nothing is extracted
+    fileobj.seek(0)
+    with zipfile.ZipFile(fileobj) as archive:
+        return [info.filename for info in archive.infolist() if not info.is_dir()]
+
+
+def open_decompressed(filename: str, fileobj: BinaryIO, member: str = None) -> BinaryIO:
+    fileobj.seek(0)
+    match compressed_types.get(PurePath(filename).suffix.lower()):
+        case "gzip":
+            return gzip.GzipFile(fileobj=fileobj, mode="rb")
+        case "bz2":
+            return bz2.BZ2File(fileobj, mode="rb")
+        case "xz":
+            return lzma.LZMAFile(fileobj, mode="rb")
+        case "zstd":
+            import zstandard
+
+            return zstandard.ZstdDecompressor().stream_reader(fileobj)
+        case "zip":
+            if member is None:
+                raise ValueError("A member must be chosen to read from a zip archive.")
+            # ZipFile.open decompresses just this member, on demand
+            return zipfile.ZipFile(fileobj).open(member)
+        case _:
+            raise ValueError(f"Not a supported compressed file: {filename}")
+
+
+def _chunks(stream: BinaryIO):
+    total = 0
+    with stream:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            total += len(chunk)
+            if total > max_decompressed_size:
+                raise ValueError(
+                    f"The decompressed file is larger than the limit of {max_decompressed_size // (1 << 20)} MiB."
+                )
+            yield chunk
+
+
+def decompress_text(
+    filename: str, fileobj: BinaryIO, member: str = None, encoding: str = "utf-8"
+) -> str:
+    # decode incrementally, so that multi-byte characters split across chunks are handled correctly
+    decoder = codecs.getincrementaldecoder(encoding)()
+    text = StringIO()
+    for chunk in _chunks(open_decompressed(filename, fileobj, member)):
+        text.write(decoder.decode(chunk))
+    text.write(decoder.decode(b"", final=True))
+    return text.getvalue()
+
+
+def decompress_bytes(filename: str, fileobj: BinaryIO, member: str = None) -> bytearray:
+    data = bytearray()
+    for chunk in _chunks(open_decompressed(filename, fileobj, member)):
+        data += chunk
+    return data
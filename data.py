@@ -1,15 +1,134 @@
+import base64
 from io import StringIO
+from enum import Enum
+import hashlib
+import itertools
+import os
+from pathlib import Path
 import re
+import struct
+import uuid
 from typing import List
 import numpy as np
-from dataclasses import dataclass
+import pandas as pd
+from dataclasses import dataclass, fields, replace
 from constants import CommentCharacters, MarkerStyles, LineStyles, Delimiters
 from text import parse_unit, process_fit, process_units
 import csv
 
 
+# Versions are drawn from one counter shared by every model object, so they only ever go up, and a version
+# number is never reused, even by a different object.
+_versions = itertools.count(1)
+
+
+class Versioned:
+    # Every model object carries a version, which changes whenever one of its fields is set or one of its
+    # children changes. Each object knows its parent, so a change anywhere in the tree also changes the
+    # version of the DataSeries or FigureProperties at the top of it. Comparing versions is then enough to
+    # tell whether anything has changed, without comparing (or hashing) the objects themselves.
+    # Private attributes (starting with an underscore) don't count as changes.
+    _version = 0
+    _parent = None
+    _digest = None
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if not name.startswith("_"):
+            if isinstance(value, Versioned):
+                object.__setattr__(value, "_parent", self)
+            self._touch()
+
+    def _touch(self):
+        version = next(_versions)
+        node = self
+        while node is not None:
+            object.__setattr__(node, "_version", version)
+            object.__setattr__(node, "_digest", None)
+            node = node._parent
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def digest(self) -> bytes:
+        # Merkle-style: the digest covers this object's own fields and the digests of its children. The children
+        # cache their digests until they next change, so after a change only the objects on the path from the
+        # change up to the root are hashed again.
+        if self._digest is None:
+            h = _hasher()
+            _update(h, type(self).__name__)
+            for f in fields(self):
+                _update(h, f.name)
+                _update(h, getattr(self, f.name))
+            object.__setattr__(self, "_digest", h.digest())
+        return self._digest
+
+    def fingerprint(self) -> str:
+        return self.digest().hex()
+
+
+# Fingerprints use blake2b over a fixed, explicit encoding of each value (little-endian float64 for numbers,
+# UTF-8 for strings, names for enums), rather than hash() or pickle, so they are the same in every process and
+# on every Python version, and can be used as keys in caches shared between them.
+def _hasher():
+    return hashlib.blake2b(digest_size=16)
+
+
+def _update(h, value):
+    match value:
+        case Versioned() | SeriesBuffer():
+            h.update(b"H" + value.digest())
+        case None:
+            h.update(b"N")
+        case bool():
+            h.update(b"T" if value else b"F")
+        case Enum():
+            _update(h, value.name)
+        case str():
+            encoded = value.encode("utf-8")
+            h.update(b"S" + struct.pack("<Q", len(encoded)) + encoded)
+        case int() | float() | np.integer() | np.floating():
+            h.update(b"D" + struct.pack("<d", float(value)))
+        case np.ndarray():
+            encoded = np.ascontiguousarray(value, dtype="<f8").tobytes()
+            h.update(b"A" + struct.pack("<Q", len(encoded)) + encoded)
+        case list() | tuple() if len(value) > 0 and all(
+            isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, bool) for v in value
+        ):
+            # the same as the array of them, since e.g. fit_params is an array when fitted but a list once loaded
+            _update(h, np.array(value, dtype="<f8"))
+        case list() | tuple():
+            h.update(b"L" + struct.pack("<Q", len(value)))
+            for v in value:
+                _update(h, v)
+        case _:
+            raise TypeError(f"Can't fingerprint a value of type {type(value).__name__}")
+
+
+# Arrays are serialised as the base64 of their raw little-endian float64 bytes rather than as lists of numbers,
+# which is several times smaller and avoids converting every value to and from decimal text. decode_array
+# builds the array directly on top of the decoded bytes, without copying them again.
+def encode_array(array: np.array) -> dict:
+    array = np.ascontiguousarray(array, dtype="<f8")
+    return {
+        "dtype": "<f8",
+        "shape": list(array.shape),
+        "base64": base64.b64encode(array.data).decode("ascii"),
+    }
+
+
+def decode_array(encoded) -> np.array:
+    # older files stored plain lists of numbers
+    if isinstance(encoded, list):
+        return np.array(encoded, dtype=np.float64)
+    # storage backends which keep arrays as binary hand back the bytes themselves, rather than base64
+    raw = encoded["bytes"] if "bytes" in encoded else base64.b64decode(encoded["base64"])
+    return np.frombuffer(raw, dtype=encoded["dtype"]).reshape(encoded["shape"])
+
+
 @dataclass
-class Color:
+class Color(Versioned):
     auto_color: bool
     color: str
     opacity: float = 1
@@ -42,7 +161,7 @@ class Color:
 
 
 @dataclass
-class Marker:
+class Marker(Versioned):
     style: MarkerStyles
     color: Color
     size: float
@@ -68,7 +187,7 @@ class Marker:
 
 
 @dataclass
-class Line:
+class Line(Versioned):
     style: LineStyles
     color: Color
     width: float
@@ -93,7 +212,7 @@ class Line:
 
 
 @dataclass
-class LegendEntry:
+class LegendEntry(Versioned):
     show: bool
     label: str
     attempt_render: bool = True
@@ -118,7 +237,7 @@ class LegendEntry:
 
 
 @dataclass
-class LineOfBestFit:
+class LineOfBestFit(Versioned):
     show: bool
     line: Line
     fit_type: str
@@ -146,7 +265,7 @@ class LineOfBestFit:
             show=d["show"],
             line=Line.from_dict(d["line"]),
             fit_type=d["fit_type"],
-            fit_params=d["fit_params"],
+            fit_params=list(d["fit_params"]),
             legend_entry=LegendEntry.from_dict(d["legend_entry"]),
             r_squared=d["r_squared"],
             attempt_plot=d["attempt_plot"],
@@ -264,34 +383,571 @@ fit_label = f{repr(label)}
         return line_of_best_fit
 
 
-@dataclass
-class DataSeries:
+@dataclass(frozen=True)
+class SeriesStats:
+    # Summary statistics for one series, shared by marking, fitting and plotting so that none of them has to
+    # scan the data again. NaNs are counted, and otherwise ignored.
+    count: int
+    x_nan: int
+    y_nan: int
+    x_min: float
+    x_max: float
+    y_min: float
+    y_max: float
+    x_sum: float
+    y_sum: float
+    # x is non-decreasing, strictly increasing, strictly decreasing
+    x_sorted: bool
+    x_increasing: bool
+    x_decreasing: bool
+
+    @property
+    def x_mean(self) -> float:
+        return self.x_sum / (self.count - self.x_nan) if self.count > self.x_nan else np.nan
+
+    @property
+    def y_mean(self) -> float:
+        return self.y_sum / (self.count - self.y_nan) if self.count > self.y_nan else np.nan
+
+    @property
+    def x_monotonic(self) -> bool:
+        return self.x_increasing or self.x_decreasing
+
+    def to_dict(self):
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**{f.name: d[f.name] for f in fields(cls)})
+
+    # larger data is summarised a chunk at a time, so that a memory-mapped series is never read in all at once
+    chunk_rows = 1 << 20
+
+    @classmethod
+    def compute(cls, data: np.array) -> "SeriesStats":
+        if len(data) > cls.chunk_rows:
+            stats = cls.compute(data[: cls.chunk_rows])
+            for start in range(cls.chunk_rows, len(data), cls.chunk_rows):
+                stats = stats.appended(data[start - 1, 0], data[start : start + cls.chunk_rows])
+            return stats
+        x, y = data[:, 0], data[:, 1]
+        x_nan, y_nan = np.isnan(x), np.isnan(y)
+        dx = np.diff(x)
+        return cls(
+            count=len(data),
+            x_nan=int(x_nan.sum()),
+            y_nan=int(y_nan.sum()),
+            x_min=float(np.min(x, where=~x_nan, initial=np.inf)) if len(x) > x_nan.sum() else np.nan,
+            x_max=float(np.max(x, where=~x_nan, initial=-np.inf)) if len(x) > x_nan.sum() else np.nan,
+            y_min=float(np.min(y, where=~y_nan, initial=np.inf)) if len(y) > y_nan.sum() else np.nan,
+            y_max=float(np.max(y, where=~y_nan, initial=-np.inf)) if len(y) > y_nan.sum() else np.nan,
+            x_sum=float(np.sum(x, where=~x_nan)),
+            y_sum=float(np.sum(y, where=~y_nan)),
+            x_sorted=bool(np.all(dx >= 0)),
+            x_increasing=bool(np.all(dx > 0)),
+            x_decreasing=bool(np.all(dx < 0)),
+        )
+
+    def appended(self, last_x: float, rows: np.array) -> "SeriesStats":
+        # the stats after appending rows, from the stats of the new rows alone. last_x is the x-value of the
+        # last row before they were appended.
+        new = SeriesStats.compute(rows)
+        if self.count == 0:
+            return new
+        first_x = rows[0, 0]
+        return SeriesStats(
+            count=self.count + new.count,
+            x_nan=self.x_nan + new.x_nan,
+            y_nan=self.y_nan + new.y_nan,
+            x_min=float(np.fmin(self.x_min, new.x_min)),
+            x_max=float(np.fmax(self.x_max, new.x_max)),
+            y_min=float(np.fmin(self.y_min, new.y_min)),
+            y_max=float(np.fmax(self.y_max, new.y_max)),
+            x_sum=self.x_sum + new.x_sum,
+            y_sum=self.y_sum + new.y_sum,
+            x_sorted=self.x_sorted and new.x_sorted and bool(last_x <= first_x),
+            x_increasing=self.x_increasing and new.x_increasing and bool(last_x < first_x),
+            x_decreasing=self.x_decreasing and new.x_decreasing and bool(last_x > first_x),
+        )
+
+    def edited(self, data: np.array, rows: np.array, column: int, old: np.array) -> "SeriesStats":
+        # The stats after the values in rows of one column changed from old to their current values in data.
+        # Returns None if that can't be worked out without a full scan: when an old value was the minimum or
+        # maximum and may no longer be, or when the order of an unsorted x column may have changed.
+        new = data[rows, column]
+        axis = "xy"[column]
+        lo, hi = getattr(self, f"{axis}_min"), getattr(self, f"{axis}_max")
+        old_finite, new_finite = old[~np.isnan(old)], new[~np.isnan(new)]
+        if len(old_finite) > 0 and (
+            (old_finite.min() <= lo and (len(new_finite) == 0 or new_finite.min() > lo))
+            or (old_finite.max() >= hi and (len(new_finite) == 0 or new_finite.max() < hi))
+        ):
+            return None
+        changes = {
+            f"{axis}_nan": getattr(self, f"{axis}_nan") + int(np.isnan(new).sum() - np.isnan(old).sum()),
+            f"{axis}_sum": getattr(self, f"{axis}_sum") + float(new_finite.sum() - old_finite.sum()),
+        }
+        if len(new_finite) > 0:
+            changes[f"{axis}_min"] = float(np.fmin(lo, new_finite.min()))
+            changes[f"{axis}_max"] = float(np.fmax(hi, new_finite.max()))
+        elif self.count == changes[f"{axis}_nan"]:
+            changes[f"{axis}_min"] = changes[f"{axis}_max"] = np.nan
+        if column == 0:
+            if not (self.x_sorted or self.x_decreasing):
+                return None
+            # only the differences either side of each edited row can have changed
+            pairs = np.unique(np.concatenate((rows - 1, rows)))
+            pairs = pairs[(pairs >= 0) & (pairs < len(data) - 1)]
+            dx = data[pairs + 1, 0] - data[pairs, 0]
+            for flag, ok in [
+                ("x_sorted", np.all(dx >= 0)),
+                ("x_increasing", np.all(dx > 0)),
+                ("x_decreasing", np.all(dx < 0)),
+            ]:
+                # a local check can show that an order has been broken, but not that one has been made
+                if ok and not getattr(self, flag):
+                    return None
+                changes[flag] = getattr(self, flag) and bool(ok)
+        return replace(self, **changes)
+
+
+class SeriesBuffer:
+    # x and y stored together as the two columns of one preallocated float64 array. The capacity doubles when it
+    # runs out, so appending rows is amortised O(1), and x, y and data are all views rather than copies.
+    # A buffer can also wrap an existing (n, 2) array without copying it (see from_array). It then only makes its
+    # own copy the first time it is modified, so the wrapped array is never written to.
+    min_capacity = 16
+    # The fingerprint of the data is built from the digests of fixed-size blocks of rows. Edits only
+    # invalidate the blocks they touch, so re-fingerprinting after an edit only hashes those blocks again.
+    block_rows = 4096
+
+    def __init__(self, x: np.array, y: np.array):
+        x = np.asarray(x, dtype=np.float64).ravel()
+        y = np.asarray(y, dtype=np.float64).ravel()
+        if len(x) != len(y):
+            raise ValueError(f"x and y must be the same length, not {len(x)} and {len(y)}")
+        self._length = len(x)
+        self._data = self._allocate(max(self.min_capacity, self._length))
+        self._data[: self._length, 0] = x
+        self._data[: self._length, 1] = y
+        self._owned = True
+        self._blocks = []
+        self._stats = None
+
+    @classmethod
+    def from_array(cls, data: np.array) -> "SeriesBuffer":
+        buffer = cls.__new__(cls)
+        buffer._data = data
+        buffer._length = len(data)
+        buffer._owned = False
+        buffer._blocks = []
+        buffer._stats = None
+        return buffer
+
+    def __len__(self):
+        return self._length
+
+    def __eq__(self, other):
+        if not isinstance(other, SeriesBuffer):
+            return NotImplemented
+        return np.array_equal(self.data, other.data)
+
+    # only the rows in use are pickled (and hashed by st.cache_data), not the spare capacity
+    def __reduce__(self):
+        return (SeriesBuffer, (self.x.copy(), self.y.copy()))
+
+    @property
+    def data(self) -> np.array:
+        return self._data[: self._length]
+
+    @property
+    def x(self) -> np.array:
+        return self._data[: self._length, 0]
+
+    @property
+    def y(self) -> np.array:
+        return self._data[: self._length, 1]
+
+    @property
+    def capacity(self) -> int:
+        return len(self._data)
+
+    @property
+    def nbytes(self) -> int:
+        return self._data.nbytes
+
+    @property
+    def shared(self) -> bool:
+        # True until the first modification of a buffer created with from_array
+        return not self._owned
+
+    def _invalidate(self, start: int, stop: int = None):
+        # forget the digests of the blocks covering rows start to stop. With no stop, every block from start
+        # onwards is dropped, since the rows after an insertion or deletion all move.
+        first = start // self.block_rows
+        if stop is None:
+            del self._blocks[first:]
+        else:
+            for i in range(first, min(len(self._blocks), (stop - 1) // self.block_rows + 1)):
+                self._blocks[i] = None
+
+    def digest(self) -> bytes:
+        n_blocks = -(-self._length // self.block_rows)
+        self._blocks.extend([None] * (n_blocks - len(self._blocks)))
+        for i, block in enumerate(self._blocks):
+            if block is None:
+                rows = self.data[i * self.block_rows : (i + 1) * self.block_rows]
+                self._blocks[i] = hashlib.blake2b(
+                    np.ascontiguousarray(rows, dtype="<f8").tobytes(), digest_size=16
+                ).digest()
+        h = _hasher()
+        h.update(struct.pack("<Q", self._length))
+        for block in self._blocks:
+            h.update(block)
+        return h.digest()
+
+    @property
+    def stats(self) -> SeriesStats:
+        # computed once, then kept up to date by each edit where that's cheaper than starting again
+        if self._stats is None:
+            self._stats = SeriesStats.compute(self.data)
+        return self._stats
+
+    def _allocate(self, capacity: int) -> np.array:
+        return np.zeros((capacity, 2))
+
+    def _reserve(self, length: int):
+        if length <= self.capacity and self._owned:
+            return
+        capacity = max(self.min_capacity, self.capacity)
+        while capacity < length:
+            capacity *= 2
+        data = self._allocate(capacity)
+        data[: self._length] = self.data
+        self._data = data
+        self._owned = True
+
+    def append(self, x: np.array, y: np.array):
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        if len(x) != len(y):
+            raise ValueError(f"x and y must be the same length, not {len(x)} and {len(y)}")
+        self._reserve(self._length + len(x))
+        self._invalidate(self._length)
+        self._data[self._length : self._length + len(x), 0] = x
+        self._data[self._length : self._length + len(x), 1] = y
+        if self._stats is not None and len(x) > 0:
+            last_x = self._data[self._length - 1, 0] if self._length > 0 else np.nan
+            self._stats = self._stats.appended(last_x, self._data[self._length : self._length + len(x)])
+        self._length += len(x)
+
+    def delete(self, rows):
+        # remove all of the rows at once with a single mask, rather than shifting the array once per row
+        keep = np.ones(self._length, dtype=bool)
+        keep[rows] = False
+        kept = self.data[keep]
+        if len(kept) < self._length:
+            self._invalidate(int(np.argmin(keep)))
+        self._reserve(self._length)
+        self._data[: len(kept)] = kept
+        self._data[len(kept) : self._length] = 0
+        self._length = len(kept)
+        self._stats = None
+
+    def insert(self, rows, x: np.array, y: np.array):
+        # the inverse of delete: rows are the (sorted) indices the new values will have once inserted
+        rows = np.atleast_1d(np.asarray(rows, dtype=np.intp))
+        length = self._length + len(rows)
+        if len(rows) > 0 and (rows.min() < 0 or rows.max() >= length):
+            raise IndexError(f"Row index out of range for {length} rows")
+        inserted = np.zeros(length, dtype=bool)
+        inserted[rows] = True
+        kept = self.data.copy()
+        if len(rows) > 0:
+            self._invalidate(int(rows.min()))
+        self._reserve(length)
+        self._data[:length][~inserted] = kept
+        self._data[rows, 0] = x
+        self._data[rows, 1] = y
+        self._length = length
+        self._stats = None
+
+    def set_values(self, rows, column: int, values):
+        rows = np.atleast_1d(np.asarray(rows, dtype=np.intp))
+        if len(rows) > 0 and (rows.min() < 0 or rows.max() >= self._length):
+            raise IndexError(f"Row index out of range for {self._length} rows")
+        self._reserve(self._length)
+        old = self._data[rows, column].copy()
+        self._data[rows, column] = values
+        if self._stats is not None:
+            self._stats = self._stats.edited(self.data, rows, column, old)
+        for block in np.unique(rows // self.block_rows):
+            self._invalidate(int(block) * self.block_rows, int(block + 1) * self.block_rows)
+
+    def set_column(self, column: int, values: np.array):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) != self._length:
+            raise ValueError(f"Expected {self._length} values, not {len(values)}")
+        self._reserve(self._length)
+        self._data[: self._length, column] = values
+        self._invalidate(0)
+        self._stats = None
+
+
+def map_array(directory: Path, shape: tuple, data: np.array = None) -> np.memmap:
+    # a new float64 array backed by a file in directory, optionally filled with data. The file is unlinked
+    # straight away: the mapping keeps it alive for as long as the array is in use, and the OS reclaims the
+    # space as soon as it isn't, so no files are ever left behind. (Where a mapped file can't be unlinked,
+    # e.g. on Windows, it is left for the usual clean-up of the storage area.)
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{uuid.uuid4().hex}.f8"
+    array = np.memmap(path, dtype="<f8", mode="w+", shape=shape)
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    if data is not None:
+        # copied across in chunks, so that data which is itself mapped isn't read into memory all at once
+        for start in range(0, len(data), SeriesStats.chunk_rows):
+            array[start : start + SeriesStats.chunk_rows] = data[start : start + SeriesStats.chunk_rows]
+    return array
+
+
+class MappedSeriesBuffer(SeriesBuffer):
+    # A SeriesBuffer whose rows live in a memory-mapped file instead of in RAM. Only the pages which are read
+    # or written are paged in, and the OS is free to drop them again, so a very large series costs little
+    # memory while it isn't being looked at. Growing the buffer maps a new, larger file.
+
+    @classmethod
+    def from_array(cls, data: np.array, directory: Path = None) -> "MappedSeriesBuffer":
+        buffer = super().from_array(data)
+        buffer._directory = Path(directory)
+        return buffer
+
+    def _allocate(self, capacity: int) -> np.array:
+        return map_array(self._directory, (capacity, 2))
+
+
+@dataclass(init=False)
+class DataSeries(Versioned):
     name: str
-    x: np.array
-    y: np.array
+    buffer: SeriesBuffer
     marker: Marker
     line: Line
     legend_entry: LegendEntry
     line_of_best_fit: LineOfBestFit
     attempt_plot: bool = True
-    x_original: np.array = None
-    y_original: np.array = None
+    _stored_stats = None
+
+    def __init__(
+        self,
+        name: str,
+        x: np.array,
+        y: np.array,
+        marker: Marker,
+        line: Line,
+        legend_entry: LegendEntry,
+        line_of_best_fit: LineOfBestFit,
+        attempt_plot: bool = True,
+        x_original: np.array = None,
+        y_original: np.array = None,
+        data: np.array = None,
+        stats: SeriesStats = None,
+    ):
+        # data is an alternative to x and y: an (n, 2) float64 array of both, which is used as it is, without copying.
+        # It can also be a function returning that array, which isn't called until the data is first needed (see
+        # __getattr__). stats, if known, saves working them out from the data.
+        self.name = name
+        self.marker = marker
+        self.line = line
+        self.legend_entry = legend_entry
+        self.line_of_best_fit = line_of_best_fit
+        self.attempt_plot = attempt_plot
+        # The original data (for reset_data) is copy-on-write: the buffer shares it until the first edit,
+        # so a series that is never edited only stores its data once.
+        self._stored_stats = stats
+        if callable(data):
+            self._load = data
+        elif data is not None:
+            self._set_data(data)
+        elif x_original is None or y_original is None:
+            self._original = self._read_only(x, y)
+            self.buffer = SeriesBuffer.from_array(self._original)
+        else:
+            self._original = self._read_only(x_original, y_original)
+            self.buffer = SeriesBuffer(x, y)
+
+    def _set_data(self, data: np.array):
+        # not a change to the series, so the version is left alone
+        self._original = np.asarray(data, dtype=np.float64)
+        self._original.flags.writeable = False
+        object.__setattr__(self, "buffer", SeriesBuffer.from_array(self._original))
+        if self._stored_stats is not None and self._stored_stats.count == len(self._original):
+            self.buffer._stats = self._stored_stats
+
+    def load(self):
+        # read in the data of a lazily loaded series now, rather than when it's first used
+        if not self.loaded:
+            self._set_data(self._load())
+            del self._load
+
+    def __getattr__(self, name):
+        # only called for attributes which haven't been set: the data of a series which is loaded lazily
+        if name not in ("buffer", "_original") or self.loaded:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        self.load()
+        return getattr(self, name)
+
+    @property
+    def loaded(self) -> bool:
+        # False until the data of a lazily loaded series is first used
+        return "_load" not in self.__dict__
+
+    @staticmethod
+    def _read_only(x: np.array, y: np.array) -> np.array:
+        data = np.column_stack(
+            (np.asarray(x, dtype=np.float64).ravel(), np.asarray(y, dtype=np.float64).ravel())
+        )
+        data.flags.writeable = False
+        return data
+
+    @property
+    def x_original(self) -> np.array:
+        return self._original[:, 0]
+
+    @property
+    def y_original(self) -> np.array:
+        return self._original[:, 1]
+
+    @property
+    def spilled(self) -> bool:
+        return isinstance(self._original, np.memmap)
+
+    def spill(self, directory: Path):
+        # move this series' data out of RAM and into memory-mapped files in directory
+        if self.spilled:
+            return
+        shared = self.buffer.shared
+        self._original = map_array(directory, self._original.shape, self._original)
+        self._original.flags.writeable = False
+        if shared:
+            buffer = MappedSeriesBuffer.from_array(self._original, directory)
+        else:
+            buffer = MappedSeriesBuffer.from_array(map_array(directory, self.data.shape, self.data), directory)
+            buffer._owned = True
+        # the data is unchanged, so keep the fingerprint and stats rather than working them out again
+        buffer._blocks, buffer._stats = self.buffer._blocks, self.buffer._stats
+        object.__setattr__(self, "buffer", buffer)
+
+    def memory_usage(self) -> dict:
+        # bytes used by the current data, the extra bytes kept only so that the data can be reset, and the bytes
+        # of either which are in memory-mapped files rather than RAM
+        data = self.buffer.nbytes
+        original = 0 if self.buffer.shared else self._original.nbytes
+        return {
+            "data": 0 if self.spilled else data,
+            "original": 0 if self.spilled else original,
+            "mapped": data + original if self.spilled else 0,
+        }
+
+    @property
+    def x(self) -> np.array:
+        return self.buffer.x
 
-    def __post_init__(self):
-        if self.x_original is None:
-            self.x_original = self.x.copy()
-        if self.y_original is None:
-            self.y_original = self.y.copy()
+    @x.setter
+    def x(self, x: np.array):
+        self.buffer.set_column(0, x)
+        self._touch()
 
     @property
-    def data(self):
-        return np.array([self.x, self.y]).T
+    def y(self) -> np.array:
+        return self.buffer.y
+
+    @y.setter
+    def y(self, y: np.array):
+        self.buffer.set_column(1, y)
+        self._touch()
+
+    @property
+    def data(self) -> np.array:
+        # (n, 2) view of the buffer, no copy
+        return self.buffer.data
+
+    @property
+    def stats(self) -> SeriesStats:
+        if not self.loaded and self._stored_stats is not None:
+            return self._stored_stats
+        return self.buffer.stats
+
+    def __len__(self):
+        if not self.loaded and self._stored_stats is not None:
+            return self._stored_stats.count
+        return len(self.buffer)
+
+    def plot_data(self, max_points: int = 10000) -> tuple:
+        # The x and y values to draw. A series with more points than max_points is decimated: the rows are split
+        # into max_points / 2 buckets, and only the lowest and highest point of each bucket are kept, so that
+        # peaks and troughs survive. This only makes sense when x is sorted, so other series are drawn in full.
+        if len(self) <= max_points or not self.stats.x_sorted:
+            return self.x, self.y
+        buckets = max_points // 2
+        per_bucket = len(self) // buckets
+        # the remainder (less than one bucket) is always kept in full
+        y = self.y[: buckets * per_bucket].reshape(buckets, per_bucket)
+        offsets = np.arange(buckets) * per_bucket
+        rows = np.sort(
+            np.concatenate(
+                (
+                    offsets + np.argmin(y, axis=1),
+                    offsets + np.argmax(y, axis=1),
+                    np.arange(buckets * per_bucket, len(self)),
+                    [0],
+                )
+            )
+        )
+        rows = rows[np.concatenate(([True], np.diff(rows) > 0))]
+        return self.x[rows], self.y[rows]
+
+    # the buffer is changed in place, so these have to update the version themselves
+    def append_rows(self, x: np.array, y: np.array):
+        self.buffer.append(x, y)
+        self._touch()
+
+    def delete_rows(self, rows):
+        self.buffer.delete(rows)
+        self._touch()
+
+    def insert_rows(self, rows, x: np.array, y: np.array):
+        self.buffer.insert(rows, x, y)
+        self._touch()
+
+    def set_values(self, rows, column: int, values):
+        self.buffer.set_values(rows, column, values)
+        self._touch()
+
+    def apply_changes(self, changes: "EditorChanges") -> tuple:
+        # Apply a whole batch of edits from the data editor: one scatter per column for the changed cells, one
+        # masked delete and one append. Returns the old values of the changed cells and the deleted rows, so
+        # that the batch can be undone.
+        cell_old = self.data[changes.cell_rows, changes.cell_columns]
+        for column in (0, 1):
+            is_column = changes.cell_columns == column
+            if is_column.any():
+                self.buffer.set_values(changes.cell_rows[is_column], column, changes.cell_values[is_column])
+        deleted_values = self.data[changes.deleted_rows].copy()
+        if len(changes.deleted_rows) > 0:
+            self.buffer.delete(changes.deleted_rows)
+        if len(changes.added) > 0:
+            self.buffer.append(changes.added[:, 0], changes.added[:, 1])
+        self._touch()
+        return cell_old, deleted_values
 
     def to_dict(self):
         return {
             "name": self.name,
-            "x": self.x.tolist(),
-            "y": self.y.tolist(),
+            "data": encode_array(self.data),
+            "stats": self.stats.to_dict(),
             "marker": self.marker.to_dict(),
             "line": self.line.to_dict(),
             "legend_entry": self.legend_entry.to_dict(),
@@ -300,11 +956,29 @@ class DataSeries:
         }
 
     @classmethod
-    def from_dict(cls, d):
+    def from_dict(cls, d, load=None):
+        # data of {"blob": i} (from a storage.SessionReader) is read with load the first time it's used, rather
+        # than now
+        if "data" in d and "blob" in d["data"]:
+            encoded = d["data"]
+
+            def data():
+                return decode_array(encoded | {"bytes": load(encoded)})
+
+            x = y = None
+        elif "data" in d:
+            data = decode_array(d["data"])
+            x = y = None
+        else:
+            # older files stored x and y as separate lists
+            data = None
+            x, y = decode_array(d["x"]), decode_array(d["y"])
         return cls(
             name=d["name"],
-            x=np.array(d["x"]),
-            y=np.array(d["y"]),
+            x=x,
+            y=y,
+            data=data,
+            stats=SeriesStats.from_dict(d["stats"]) if "stats" in d else None,
             marker=Marker.from_dict(d["marker"]),
             line=Line.from_dict(d["line"]),
             legend_entry=LegendEntry.from_dict(d["legend_entry"]),
@@ -394,12 +1068,35 @@ class DataSeries:
         return csv.getvalue()
 
     def reset_data(self):
-        self.x = self.x_original.copy()
-        self.y = self.y_original.copy()
+        # share the original again, and drop the edited copy
+        if isinstance(self.buffer, MappedSeriesBuffer):
+            self.buffer = MappedSeriesBuffer.from_array(self._original, self.buffer._directory)
+        else:
+            self.buffer = SeriesBuffer.from_array(self._original)
+
+
+def state_fingerprint(data_series: List[DataSeries], figure_properties: "FigureProperties") -> str:
+    # the root of the tree: a stable key for this exact figure, content and styling
+    h = _hasher()
+    _update(h, [*data_series, figure_properties])
+    return h.hexdigest()
+
+
+def state_version(data_series: List[DataSeries], figure_properties: "FigureProperties") -> tuple:
+    # changes whenever anything in the figure changes, including series being added, removed or reordered
+    return (figure_properties.version, *(s.version for s in data_series))
+
+
+def memory_usage(data_series: List[DataSeries]) -> dict:
+    usage = {"data": 0, "original": 0, "mapped": 0}
+    for s in data_series:
+        for k, v in s.memory_usage().items():
+            usage[k] += v
+    return usage
 
 
 @dataclass
-class AxisProperties:
+class AxisProperties(Versioned):
     min: float | None
     max: float | None
     label: str
@@ -444,7 +1141,7 @@ class AxisProperties:
 
 
 @dataclass
-class TitleProperties:
+class TitleProperties(Versioned):
     text: str
     font_size: int
     attempt_render: bool = True
@@ -474,7 +1171,7 @@ class TitleProperties:
 
 
 @dataclass
-class LegendProperties:
+class LegendProperties(Versioned):
     show: bool
     position: str
     font_size: float
@@ -517,7 +1214,7 @@ class LegendProperties:
         return code.getvalue()
 
 @dataclass
-class FigureProperties:
+class FigureProperties(Versioned):
     x_axis: AxisProperties
     y_axis: AxisProperties
     title: TitleProperties
@@ -612,6 +1309,88 @@ def indent(
     lines = [full_indent + line[min_indent:] for line in lines]
 
 
+class NumericParseError(ValueError):
+    def __init__(self, token: str, line: int):
+        super().__init__(f"'{token}' on line {line} is not a number.")
+        self.token = token
+        self.line = line
+
+
+@dataclass
+class EditorChanges:
+    # The edits made in an st.data_editor showing a series, as arrays: the (row, column) of each changed cell
+    # and its new value, the rows deleted, and the (x, y) rows added at the end. Everything is converted and
+    # validated up front, so that a batch of edits is either applied completely or not at all.
+    cell_rows: np.array
+    cell_columns: np.array
+    cell_values: np.array
+    deleted_rows: np.array
+    added: np.array
+
+    @classmethod
+    def from_state(cls, state: dict, length: int, offset: int = 0) -> "EditorChanges":
+        # state has the format {"edited_rows": {row: {column: value}}, "deleted_rows": [row], "added_rows": [{column: value}]}
+        # If the editor only showed some of the rows, its row numbers are relative to offset.
+        cells = [
+            (int(row) + offset, column, value)
+            for row, changes in state.get("edited_rows", {}).items()
+            for column, value in changes.items()
+        ]
+        rows, columns, values = zip(*cells) if len(cells) > 0 else ((), (), ())
+        invalid = [c for c in columns if c not in ("0", "1")]
+        if len(invalid) > 0:
+            raise ValueError(f"Invalid column index: {invalid[0]}")
+        cell_rows = np.array(rows, dtype=np.intp)
+        deleted_rows = np.unique(np.array(state.get("deleted_rows", []), dtype=np.intp)) + offset
+        for name, r in (("edited", cell_rows), ("deleted", deleted_rows)):
+            if len(r) > 0 and (r.min() < 0 or r.max() >= length):
+                raise IndexError(f"An {name} row is out of range for {length} rows")
+        added = state.get("added_rows", [])
+        return cls(
+            cell_rows=cell_rows,
+            cell_columns=np.array([int(c) for c in columns], dtype=np.intp),
+            cell_values=_editor_values(values, rows),
+            deleted_rows=deleted_rows,
+            added=_editor_values(
+                [row.get(c) for row in added for c in ("0", "1")],
+                [length + i for i in range(len(added)) for _ in range(2)],
+            ).reshape(-1, 2),
+        )
+
+
+def _editor_values(values, rows) -> np.array:
+    # convert the values in one go. Empty cells are 0, anything else which isn't a number is an error.
+    raw = pd.Series(list(values), dtype=object)
+    numbers = pd.to_numeric(raw, errors="coerce").to_numpy(dtype=np.float64, copy=True)
+    empty = raw.isna().to_numpy()
+    invalid = np.isnan(numbers) & ~empty
+    if invalid.any():
+        i = int(np.argmax(invalid))
+        raise NumericParseError(str(raw[i]), rows[i] + 1)
+    numbers[empty] = 0
+    return numbers
+
+
+def parse_numbers(text: str) -> np.array:
+    # values can be separated by commas, spaces, tabs or new lines.
+    # The whole buffer is converted to float64 by numpy in one pass, rather than calling float() on each value.
+    tokens = text.replace(",", " ").split()
+    if len(tokens) == 0:
+        raise ValueError("No data found.")
+    try:
+        return np.array(tokens, dtype=np.float64)
+    except ValueError:
+        pass
+    # only search for the problem once we know there is one
+    for match in re.finditer(r"[^,\s]+", text):
+        try:
+            float(match.group())
+        except ValueError:
+            line = text.count("\n", 0, match.start()) + 1
+            raise NumericParseError(match.group(), line) from None
+    raise ValueError("Data must be numeric.")
+
+
 @dataclass
 class CSVFile:
     contents: str
@@ -620,6 +1399,9 @@ class CSVFile:
     header_rows: int = -1
     footer_rows: int = -1
     data: np.array = None
+    _numeric = None
+    _parsed_options = None
+    _content_digest = None
 
     @staticmethod
     def split_at_delim(line: str, delimiter: str) -> List[str]:
@@ -800,6 +1582,63 @@ class CSVFile:
         # if we get here, there is no footer
         return 0
 
+    def parse_options(self) -> list:
+        # everything that parse depends on, apart from the contents
+        return [self.delimiter.value, self.comment_character.value, self.header_rows, self.footer_rows]
+
+    def parse(self) -> np.array:
+        # the contents parsed into a table of strings, using the current options
+        return np.genfromtxt(
+            self.contents.split("\n"),
+            delimiter=self.delimiter.value,
+            skip_header=self.header_rows,
+            skip_footer=self.footer_rows,
+            comments=self.comment_character.value,
+            dtype=str,  # we'll convert to float later, but some columns might not be numeric
+        )
+
+    def set_data(self, table: np.array, numeric: np.array = None, options: list = None):
+        # the parsed table, along with its numeric values and the options it was parsed with, if already known
+        self.data = table
+        self._numeric = None if numeric is None else (table, numeric)
+        self._parsed_options = options
+
+    def parsed_with(self, options: list) -> bool:
+        # whether data is already the contents parsed with these options
+        return self.data is not None and self._parsed_options == options
+
+    def numeric_data(self) -> np.array:
+        # the parsed data converted to floats in one vectorised pass, with NaN wherever a cell isn't numeric.
+        # Empty cells are treated as 0, matching the behaviour when adding data from the file.
+        # The result is kept until data changes.
+        if self.data is None:
+            return None
+        if self._numeric is None or self._numeric[0] is not self.data:
+            cells = np.char.strip(self.data.astype(str))
+            cells[cells == ""] = "0"
+            frame = pd.DataFrame(cells)
+            self._numeric = (self.data, frame.apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float))
+        return self._numeric[1]
+
+    def column_summary(self) -> pd.DataFrame:
+        # per column statistics of the parsed data: the fraction of cells which are numeric, and the min and max of those cells
+        numeric = self.numeric_data()
+        cells = np.char.lower(np.char.strip(self.data.astype(str)))
+        # a literal "nan" is still a number, even though it converts to NaN
+        is_numeric = ~np.isnan(numeric) | (cells == "nan")
+        finite = np.isfinite(numeric)
+        has_finite = finite.any(axis=0)
+        col_min = np.where(finite, numeric, np.inf).min(axis=0)
+        col_max = np.where(finite, numeric, -np.inf).max(axis=0)
+        return pd.DataFrame(
+            {
+                "Numeric": is_numeric.mean(axis=0),
+                "Min": np.where(has_finite, col_min, np.nan),
+                "Max": np.where(has_finite, col_max, np.nan),
+            },
+            index=[str(i) for i in range(numeric.shape[1])],
+        )
+
     @staticmethod
     def is_numeric(string: str) -> bool:
         try:
@@ -810,6 +1649,20 @@ class CSVFile:
 
             return string.lower().strip() in ["inf", "-inf", "nan", ""]
         
+    def content_digest(self) -> str:
+        # the contents never change once uploaded, so they're only hashed once. This is also the contents' key
+        # in a blobs.BlobStore.
+        if self._content_digest is None:
+            self._content_digest = hashlib.blake2b(self.contents.encode("utf-8"), digest_size=32).hexdigest()
+        return self._content_digest
+
+    def fingerprint(self) -> str:
+        # the options are cheap to add each time
+        h = _hasher()
+        _update(h, self.content_digest())
+        _update(h, [self.delimiter, self.comment_character, self.header_rows, self.footer_rows])
+        return h.hexdigest()
+
     def to_dict(self):
         return {
             "contents": self.contents,
@@ -819,12 +1672,35 @@ class CSVFile:
             "footer_rows": self.footer_rows,
         }
     
+    def load(self):
+        # read in the contents of a lazily loaded file now, rather than when they're first used
+        if "_load_contents" in self.__dict__:
+            self.contents = self._load_contents()
+            del self._load_contents
+
+    def __getattr__(self, name):
+        # only called for attributes which haven't been set: the contents of a file which is loaded lazily
+        if name != "contents" or "_load_contents" not in self.__dict__:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        self.load()
+        return self.contents
+
     @classmethod
-    def from_dict(cls, d):
-        return cls(
-            contents=d["contents"],
+    def from_dict(cls, d, load=None):
+        # Contents of {"blob": i} (from a storage.SessionReader) or {"ref": key} (in a blobs.BlobStore) are read
+        # with load the first time they're used.
+        lazy = isinstance(d["contents"], dict)
+        csv_file = cls(
+            contents=None if lazy else d["contents"],
             delimiter=Delimiters(d["delimiter"]),
             comment_character=CommentCharacters(d["comment_character"]),
             header_rows=d["header_rows"],
             footer_rows=d["footer_rows"],
-        )
\ No newline at end of file
+        )
+        if lazy:
+            ref = d["contents"]
+            del csv_file.contents
+            csv_file._load_contents = lambda: load(ref).decode("utf-8")
+            if "ref" in ref:
+                csv_file._content_digest = ref["ref"]
+        return csv_file
\ No newline at end of file
@@ -20,6 +20,11 @@ It looks like you don't have enough data points for this type of fit. For a {fit
             return f"""**Error**
 
 It looks like your fit ({fit_type}) failed to converge for the data series {data_series}. This can happen if you have too few data points, or if the data doesn't resemble the function you're trying to fit to it."""
+    # the data series' stats show it contains NaNs, which can't be fitted
+    if isinstance(exception, ValueError) and "NaN" in str(exception):
+        return f"""**Error**
+
+The data series {data_series} contains missing or non-numeric values, so a {fit_type} fit can't be calculated. Edit or remove these values to fit the data."""
     return f"""**Error**
 
 An unrecognised error has occurred. The full error message is:
@@ -68,6 +73,11 @@ An unrecognised error has occurred. The full error message is:
 ```"""
 
 def handle_data_error(exception, data: str) -> str:
+    # parse errors know which value was the problem, so point the user straight to it
+    if getattr(exception, "token", None) is not None:
+        return f"""**Error**
+
+I couldn't understand the value `{exception.token}` on line {exception.line} of the data you entered. Check that every value is a number, and that you have used one of the supported formats to separate your values: commas, tabs, spaces, or newlines. Do not include the header row."""
     return f"""**Error**
 
 I couldn't understand the data you entered:
@@ -92,4 +102,19 @@ Please check that it is a valid string. The full error message is:
 ```"""
 
 def handle_json_error(e):
-    return e.args[0]
\ No newline at end of file
+    return e.args[0]
+
+def handle_import_error(exception, filename: str) -> str:
+    if isinstance(exception, ImportError):
+        return f"""**Error**
+
+Reading `{filename}` needs an optional package which isn't installed on this server. The full error message is:
+```
+{exception}
+```"""
+    return f"""**Error**
+
+I couldn't read any data from `{filename}`. Check that the file isn't corrupted, and that it is one of the supported formats. Binary files must contain 1D or 2D numeric arrays. The full error message is:
+```
+{exception}
+```"""
@@ -20,7 +20,8 @@ def _logarithmic(x, a, b, c):
 def _sinusoidal(x, a, b, c, d):
     return a*np.sin(b*x + c) + d
 
-def fit(fit_type: str, x_data: np.array, y_data: np.array) -> List[float]:
+def fit(fit_type: str, x_data: np.array, y_data: np.array, stats=None) -> List[float]:
+    # stats (a SeriesStats for the data, if available) saves scanning the data again for NaNs and the mean
     fit_func = None
     match fit_type:
         case "Linear":
@@ -38,15 +39,30 @@ def fit(fit_type: str, x_data: np.array, y_data: np.array) -> List[float]:
         case _:
             raise ValueError(f"Unrecognised fit type: {fit_type}")
     
+    if stats is not None and (stats.x_nan > 0 or stats.y_nan > 0):
+        raise ValueError("The data contains NaN values.")
     popt, pcov = curve_fit(fit_func, x_data, y_data)
     # get the R^2 value
     residuals = y_data - fit_func(x_data, *popt)
     ss_res = np.sum(residuals**2)
-    ss_tot = np.sum((y_data - np.mean(y_data))**2)
+    y_mean = np.mean(y_data) if stats is None else stats.y_mean
+    ss_tot = np.sum((y_data - y_mean)**2)
     r_squared = 1 - (ss_res / ss_tot)
 
     return popt, r_squared
 
+def fit_many(fit_type: str, data: List[tuple]) -> list:
+    # fit several (x, y) or (x, y, stats) data sets at once. Each result is either (popt, r_squared) or the exception
+    # raised by that fit, so that one bad data set doesn't stop the rest. The fits are done one after another: curve_fit
+    # calls the model function (in Python, holding the GIL) on every iteration, so threads wouldn't overlap them.
+    results = []
+    for xy in data:
+        try:
+            results.append(fit(fit_type, *xy))
+        except Exception as e:
+            results.append(e)
+    return results
+
 def get_fitted_data(x: np.array, fit_type: str, fit_params: List[float]) -> np.array:
     match fit_type:
         case "Linear":
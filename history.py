@@ -0,0 +1,193 @@
+import sys
+from collections import deque
+from dataclasses import dataclass, field
+from typing import List
+import numpy as np
+
+# Undo and redo for the figure. Rather than snapshotting the whole state, each change records only what it
+# touched: the old and new values of the fields of one model object that changed, or just the rows of one data
+# series that were edited. Everything else is shared with the live state, so undoing or redoing a change costs
+# time proportional to the size of that change. The history is capped at a byte budget, with the oldest
+# changes dropped first.
+
+
+def _size(value) -> int:
+    if isinstance(value, np.ndarray) or hasattr(value, "nbytes"):
+        # arrays, and anything else that reports its own size, e.g. a SeriesBuffer
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+@dataclass
+class FieldsChange:
+    target: object
+    old: dict
+    new: dict
+    # widgets showing these fields, which need resetting so they pick up the restored values
+    widget_keys: List[str] = field(default_factory=list)
+
+    def undo(self):
+        for name, value in self.old.items():
+            setattr(self.target, name, value)
+
+    def redo(self):
+        for name, value in self.new.items():
+            setattr(self.target, name, value)
+
+    def nbytes(self) -> int:
+        return _size(list(self.old.values())) + _size(list(self.new.values()))
+
+
+@dataclass
+class RowsChange:
+    # one batch of edits to a data series: changed cells, then deleted rows, then appended rows
+    series: object
+    cell_rows: np.array
+    cell_columns: np.array
+    cell_old: np.array
+    cell_new: np.array
+    deleted_rows: np.array
+    deleted_values: np.array
+    added_values: np.array
+    widget_keys: List[str] = field(default_factory=list)
+
+    def undo(self):
+        if len(self.added_values) > 0:
+            n = len(self.series)
+            self.series.delete_rows(np.arange(n - len(self.added_values), n))
+        if len(self.deleted_rows) > 0:
+            self.series.insert_rows(self.deleted_rows, self.deleted_values[:, 0], self.deleted_values[:, 1])
+        for column in (0, 1):
+            is_column = self.cell_columns == column
+            if is_column.any():
+                self.series.set_values(self.cell_rows[is_column], column, self.cell_old[is_column])
+
+    def redo(self):
+        for column in (0, 1):
+            is_column = self.cell_columns == column
+            if is_column.any():
+                self.series.set_values(self.cell_rows[is_column], column, self.cell_new[is_column])
+        if len(self.deleted_rows) > 0:
+            self.series.delete_rows(self.deleted_rows)
+        if len(self.added_values) > 0:
+            self.series.append_rows(self.added_values[:, 0], self.added_values[:, 1])
+
+    def nbytes(self) -> int:
+        return sum(
+            _size(a)
+            for a in (
+                self.cell_rows,
+                self.cell_columns,
+                self.cell_old,
+                self.cell_new,
+                self.deleted_rows,
+                self.deleted_values,
+                self.added_values,
+            )
+        )
+
+
+@dataclass
+class SeriesListChange:
+    # a data series added to (or removed from) the list of series, at the given index
+    series_list: list
+    index: int
+    series: object
+    added: bool
+    widget_keys: List[str] = field(default_factory=list)
+
+    def _add(self):
+        self.series_list.insert(min(self.index, len(self.series_list)), self.series)
+
+    def _remove(self):
+        if self.series in self.series_list:
+            self.series_list.remove(self.series)
+
+    def undo(self):
+        self._remove() if self.added else self._add()
+
+    def redo(self):
+        self._add() if self.added else self._remove()
+
+    def nbytes(self) -> int:
+        # a removed series is only kept alive by the history, so it counts against the budget
+        return sys.getsizeof(self) + (0 if self.added else self.series.memory_usage()["data"])
+
+
+@dataclass
+class CompoundChange:
+    # several changes which are undone and redone together
+    changes: list
+
+    @property
+    def widget_keys(self) -> List[str]:
+        return [key for change in self.changes for key in change.widget_keys]
+
+    def undo(self):
+        for change in reversed(self.changes):
+            change.undo()
+
+    def redo(self):
+        for change in self.changes:
+            change.redo()
+
+    def nbytes(self) -> int:
+        return sum(change.nbytes() for change in self.changes)
+
+
+class History:
+    def __init__(self, max_bytes: int = 8 * (1 << 20)):
+        self.max_bytes = max_bytes
+        self._undo = deque()
+        self._redo = []
+        self._nbytes = 0
+
+    def record(self, change):
+        self._undo.append((change, change.nbytes()))
+        self._nbytes += self._undo[-1][1]
+        # a new change makes anything that was undone unreachable
+        self._redo.clear()
+        # always keep the latest change, even if it is over budget by itself
+        while self._nbytes > self.max_bytes and len(self._undo) > 1:
+            _, nbytes = self._undo.popleft()
+            self._nbytes -= nbytes
+
+    def undo(self):
+        if not self.can_undo:
+            return None
+        change, nbytes = self._undo.pop()
+        self._nbytes -= nbytes
+        change.undo()
+        self._redo.append((change, nbytes))
+        return change
+
+    def redo(self):
+        if not self.can_redo:
+            return None
+        change, nbytes = self._redo.pop()
+        change.redo()
+        self._undo.append((change, nbytes))
+        self._nbytes += nbytes
+        return change
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+        self._nbytes = 0
+
+    @property
+    def can_undo(self) -> bool:
+        return len(self._undo) > 0
+
+    @property
+    def can_redo(self) -> bool:
+        return len(self._redo) > 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._undo)
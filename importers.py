@@ -0,0 +1,231 @@
+from dataclasses import dataclass
+import io
+from pathlib import PurePath
+from typing import Callable, Dict, List
+import zipfile
+import numpy as np
+
+# Load data from binary and columnar formats, as an alternative to CSVFile for files which aren't text.
+# Each importer returns a ColumnTable, which lists the available columns straight away but only reads
+# the columns that are actually asked for. Where the format allows it, the arrays returned are views
+# onto the uploaded bytes rather than copies.
+
+
+@dataclass
+class ColumnTable:
+    name: str
+    columns: List[str]
+    reader: Callable[[List[str]], Dict[str, np.array]]
+
+    def read(self, columns: List[str]) -> Dict[str, np.array]:
+        for column in columns:
+            if column not in self.columns:
+                raise KeyError(f"No column named {column} in {self.name}")
+        # always hand back float64, without copying if the data is already float64
+        return {
+            name: np.asarray(data, dtype=np.float64)
+            for name, data in self.reader(list(dict.fromkeys(columns))).items()
+        }
+
+    def __len__(self):
+        return len(self.columns)
+
+
+def _array_columns(name: str, shape: tuple) -> Dict[str, tuple]:
+    # 1D arrays are a single column, 2D arrays give one column per index of the second axis. Returns each
+    # column's label with the array and index (None for the whole array) it comes from, so that labels never
+    # need parsing, since names can contain brackets of their own (e.g. "temperature[K]").
+    if len(shape) == 1:
+        return {name: (name, None)}
+    if len(shape) == 2:
+        return {f"{name}[{i}]": (name, i) for i in range(shape[1])}
+    raise ValueError(f"{name} has {len(shape)} dimensions. Only 1D and 2D arrays can be imported.")
+
+
+class _BufferReader(io.RawIOBase):
+    # a read-only file over the uploaded bytes, for the libraries which want a file. Unlike BytesIO, it doesn't
+    # copy them: each read only copies what was asked for.
+    def __init__(self, buffer: memoryview):
+        self._buffer = memoryview(buffer).cast("B")
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = self._buffer[self._position : self._position + len(b)]
+        b[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        match whence:
+            case io.SEEK_SET:
+                position = offset
+            case io.SEEK_CUR:
+                position = self._position + offset
+            case io.SEEK_END:
+                position = len(self._buffer) + offset
+            case _:
+                raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def tell(self) -> int:
+        return self._position
+
+
+def _read_npy_header(stream):
+    version = np.lib.format.read_magic(stream)
+    match version:
+        case (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+        case (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+        case _:
+            raise ValueError(f"Unsupported .npy format version: {version}")
+    if dtype.hasobject:
+        raise ValueError("Arrays containing Python objects can't be imported.")
+    return shape, fortran_order, dtype
+
+
+def _npy_view(buffer: memoryview) -> np.array:
+    # build the array directly on top of the uploaded bytes instead of copying it with np.load
+    stream = _BufferReader(buffer)
+    shape, fortran_order, dtype = _read_npy_header(stream)
+    count = int(np.prod(shape))
+    array = np.frombuffer(buffer, dtype=dtype, count=count, offset=stream.tell())
+    return array.reshape(shape, order="F" if fortran_order else "C")
+
+
+def import_npy(name: str, buffer: memoryview) -> ColumnTable:
+    array = _npy_view(buffer)
+    if array.dtype.names is not None:
+        # structured array: one column per field
+        columns = list(array.dtype.names)
+        return ColumnTable(name, columns, lambda cols: {c: array[c] for c in cols})
+    # plain arrays are numbered like the columns of a CSV file
+    if array.ndim == 1:
+        return ColumnTable(name, ["0"], lambda cols: {c: array for c in cols})
+    if array.ndim != 2:
+        raise ValueError(f"{name} has {array.ndim} dimensions. Only 1D and 2D arrays can be imported.")
+    columns = [str(i) for i in range(array.shape[1])]
+    return ColumnTable(name, columns, lambda cols: {c: array[:, int(c)] for c in cols})
+
+
+def import_npz(name: str, buffer: memoryview) -> ColumnTable:
+    # only the headers are read up front. Each array is decompressed when one of its columns is requested.
+    archive = zipfile.ZipFile(_BufferReader(buffer))
+    members = {}
+    sources = {}  # column -> (array name, index)
+    for member in archive.namelist():
+        if not member.endswith(".npy"):
+            continue
+        with archive.open(member) as f:
+            shape, _, _ = _read_npy_header(f)
+        array_name = member[: -len(".npy")]
+        members[array_name] = member
+        sources.update(_array_columns(array_name, shape))
+
+    def reader(cols):
+        out = {}
+        loaded = {}
+        for c in cols:
+            array_name, index = sources[c]
+            if array_name not in loaded:
+                with archive.open(members[array_name]) as f:
+                    loaded[array_name] = np.lib.format.read_array(f, allow_pickle=False)
+            out[c] = loaded[array_name] if index is None else loaded[array_name][:, index]
+        return out
+
+    return ColumnTable(name, list(sources), reader)
+
+
+def import_parquet(name: str, buffer: memoryview) -> ColumnTable:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(pa.BufferReader(buffer))
+    columns = list(parquet_file.schema_arrow.names)
+
+    def reader(cols):
+        # only the requested column chunks are read and decoded
+        table = parquet_file.read(columns=cols)
+        return {c: table.column(c).to_numpy() for c in cols}
+
+    return ColumnTable(name, columns, reader)
+
+
+def import_arrow(name: str, buffer: memoryview) -> ColumnTable:
+    import pyarrow as pa
+
+    source = pa.py_buffer(buffer)
+    try:
+        table = pa.ipc.open_file(source).read_all()
+    except pa.ArrowInvalid:
+        # not the file format, so try the streaming format instead
+        table = pa.ipc.open_stream(source).read_all()
+    columns = list(table.column_names)
+
+    def reader(cols):
+        # record batches reference the uploaded buffer, so this is zero-copy for numeric columns without nulls
+        return {c: table.column(c).combine_chunks().to_numpy(zero_copy_only=False) for c in cols}
+
+    return ColumnTable(name, columns, reader)
+
+
+def import_hdf5(name: str, buffer: memoryview) -> ColumnTable:
+    import h5py
+
+    h5_file = h5py.File(_BufferReader(buffer), "r")
+    datasets = {}
+    sources = {}  # column -> (dataset path, index)
+
+    def visit(path, item):
+        if isinstance(item, h5py.Dataset) and item.ndim in (1, 2) and item.dtype.kind in "biuf":
+            datasets[path] = item
+            sources.update(_array_columns(path, item.shape))
+
+    h5_file.visititems(visit)
+
+    def reader(cols):
+        # slicing a dataset only reads the selected hyperslab from the file
+        out = {}
+        for c in cols:
+            path, index = sources[c]
+            out[c] = datasets[path][()] if index is None else datasets[path][:, index]
+        return out
+
+    return ColumnTable(name, list(sources), reader)
+
+
+importers = {
+    ".npy": import_npy,
+    ".npz": import_npz,
+    ".parquet": import_parquet,
+    ".pq": import_parquet,
+    ".arrow": import_arrow,
+    ".feather": import_arrow,
+    ".ipc": import_arrow,
+    ".h5": import_hdf5,
+    ".hdf5": import_hdf5,
+}
+
+
+def can_import(filename: str) -> bool:
+    return PurePath(filename).suffix.lower() in importers
+
+
+def import_file(filename: str, buffer: memoryview) -> ColumnTable:
+    suffix = PurePath(filename).suffix.lower()
+    if suffix not in importers:
+        raise ValueError(f"Unsupported file type: {suffix}")
+    table = importers[suffix](filename, memoryview(buffer))
+    if len(table) == 0:
+        raise ValueError(f"No numeric columns were found in {filename}")
+    return table
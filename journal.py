@@ -0,0 +1,381 @@
+import base64
+import copy
+import datetime
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+from typing import List
+import numpy as np
+
+from data import decode_array
+from storage import SessionInfo, SessionReader, Storage, file_version, split_blobs
+
+# A Storage that records each save as a list of operations appended to a journal, rather than rewriting the
+# whole session. Changing one setting appends {"op": "set", "path": [...], "value": ...}, and editing a few rows
+# of a data series appends just the rows that changed. The full session (the snapshot) is kept in the wrapped
+# storage, and is rewritten (the journal is compacted) once the journal grows past compaction_ratio times the
+# size of the snapshot. Reading a session replays its journal on top of the snapshot.
+#
+# Each save in the journal is one line of JSON, {"seq": n, "time": ..., "ops": [...]}, and the snapshot records
+# the seq of the last save it includes, so a crash between writing a snapshot and removing the old journal
+# can't apply the same saves twice. A save only partly written when the process died is ignored, and the next
+# save compacts the journal rather than appending after it.
+#
+# The saves since the last snapshot are also a history of the session which can be browsed (revisions) and
+# restored (read with a revision).
+
+# Arrays are compared a block of rows at a time, using the digest of each block of their base64 text. A block is
+# a multiple of 3 rows (of 8-byte values), so it's always a whole number of base64 characters, and the changed
+# rows can be copied into the journal without decoding the array. Blocks are small, so that editing a cell only
+# records a few rows; the cost is a digest to remember for every block_rows rows.
+block_rows = 48
+# compact once the journal is larger than this fraction of the snapshot (as stored, so compressed)
+compaction_ratio = 1.0
+# or has this many saves in it, to keep replaying it quick
+max_journal_saves = 1000
+
+
+def _is_array(node) -> bool:
+    # an array from data.encode_array, or as read back from storage (see storage.join_blobs)
+    return isinstance(node, dict) and "shape" in node and ("base64" in node or "bytes" in node)
+
+
+def _block_chars(shape: list) -> int:
+    # base64 characters in a block of rows
+    return block_rows * (shape[1] if len(shape) > 1 else 1) * 8 * 4 // 3
+
+
+def _array_blocks(encoded: dict) -> List[bytes]:
+    chars = _block_chars(encoded["shape"])
+    text = encoded["base64"] if "base64" in encoded else base64.b64encode(encoded["bytes"]).decode("ascii")
+    return [
+        hashlib.blake2b(text[i : i + chars].encode("ascii"), digest_size=16).digest()
+        for i in range(0, len(text), chars)
+    ]
+
+
+def _shadow(node):
+    # what's remembered of the last saved document: all of it except arrays, which are kept as block digests
+    if _is_array(node):
+        return {"dtype": node["dtype"], "shape": list(node["shape"]), "blocks": _array_blocks(node)}
+    if isinstance(node, dict):
+        return {k: _shadow(v) for k, v in node.items()}
+    if isinstance(node, list):
+        return [_shadow(v) for v in node]
+    return node
+
+
+def _array_ops(path: list, old: dict, new: dict) -> List[dict]:
+    shape = list(new["shape"])
+    chars = _block_chars(shape)
+    new_blocks = _array_blocks(new)
+    old_blocks = old["blocks"] if old["shape"][1:] == shape[1:] and old["dtype"] == new["dtype"] else []
+    changed = [i for i, block in enumerate(new_blocks) if i >= len(old_blocks) or old_blocks[i] != block]
+    ops = []
+    if shape != old["shape"] or old["dtype"] != new["dtype"]:
+        ops.append({"op": "resize", "path": path, "dtype": new["dtype"], "shape": shape})
+    # one op for each run of consecutive changed blocks
+    i = 0
+    while i < len(changed):
+        j = i
+        while j + 1 < len(changed) and changed[j + 1] == changed[j] + 1:
+            j += 1
+        ops.append(
+            {
+                "op": "rows",
+                "path": path,
+                "start": changed[i] * block_rows,
+                "base64": new["base64"][changed[i] * chars : (changed[j] + 1) * chars],
+            }
+        )
+        i = j + 1
+    return ops
+
+
+def diff(old, new, path: list = None) -> List[dict]:
+    # the operations which turn old (a shadow) into new (a document)
+    path = [] if path is None else path
+    if _is_array(new) and isinstance(old, dict) and "blocks" in old:
+        return _array_ops(path, old, new)
+    if isinstance(new, dict) and isinstance(old, dict) and not _is_array(new):
+        ops = [{"op": "delete", "path": path + [k]} for k in old if k not in new]
+        for k, v in new.items():
+            if k not in old:
+                ops.append({"op": "set", "path": path + [k], "value": v})
+            else:
+                ops.extend(diff(old[k], v, path + [k]))
+        return ops
+    if isinstance(new, list) and isinstance(old, list) and len(new) == len(old):
+        return [op for i, (o, n) in enumerate(zip(old, new)) for op in diff(o, n, path + [i])]
+    if old == new:
+        return []
+    return [{"op": "set", "path": path, "value": new}]
+
+
+def _parent(document, path: list):
+    node = document
+    for p in path[:-1]:
+        node = node[p]
+    return node
+
+
+def replay(document: dict, saves: List[dict], metadata_only: bool = False) -> dict:
+    # apply the operations of each save to document (from storage.read), in place. With metadata_only, the
+    # document is from storage.read_metadata and the arrays in it are left alone, apart from their shapes.
+    arrays = {}  # id of an array's node -> (node, array), so each array is only decoded once
+    for save in saves:
+        for op in save["ops"]:
+            node = _parent(document, op["path"])
+            name = op["path"][-1]
+            match op["op"]:
+                case "set":
+                    node[name] = copy.deepcopy(op["value"])
+                case "delete":
+                    node.pop(name, None)
+                case "resize" if metadata_only:
+                    node[name]["shape"] = op["shape"]
+                case "rows" if metadata_only:
+                    pass
+                case "resize":
+                    entry = arrays.get(id(node[name]))
+                    old = entry[1] if entry is not None else decode_array(node[name])
+                    array = np.zeros(op["shape"], dtype=op["dtype"])
+                    rows = min(len(old), len(array))
+                    array[:rows] = old[:rows]
+                    node[name] = {"dtype": op["dtype"], "shape": op["shape"]}
+                    arrays[id(node[name])] = (node[name], array)
+                case "rows":
+                    entry = arrays.get(id(node[name]))
+                    if entry is None:
+                        entry = (node[name], decode_array(node[name]).copy())
+                        arrays[id(node[name])] = entry
+                    array = entry[1]
+                    rows = np.frombuffer(base64.b64decode(op["base64"]), dtype=array.dtype)
+                    rows = rows.reshape((-1,) + array.shape[1:])
+                    array[op["start"] : op["start"] + len(rows)] = rows
+                case _:
+                    raise ValueError(f"Unknown journal operation: {op['op']}")
+    for node, array in arrays.values():
+        node.pop("base64", None)
+        node["shape"] = list(array.shape)
+        node["bytes"] = array.tobytes()
+    return document
+
+
+class JournalStorage(Storage):
+    def __init__(self, snapshots: Storage, directory: Path):
+        self.snapshots = snapshots
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # key -> (shadow of the last document written or read, seq of the last save, seq of the snapshot, snapshot
+        # size, journal size, version). If the session's version has changed since, another process has saved it, and the rest is out
+        # of date.
+        self._last = {}
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.jsonl"
+
+    def _saves(self, key: str, after: int) -> List[dict]:
+        path = self._path(key)
+        if not path.exists():
+            return []
+        saves = []
+        with path.open("rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # the last save is still being written by another process, or was cut short. It isn't
+                    # removed here, since it may not be finished, but nothing is appended after it (see write).
+                    break
+                save = json.loads(line)
+                if save["seq"] > after:
+                    saves.append(save)
+        return saves
+
+    def _seq(self, key: str) -> int:
+        # the seq of the last save in storage
+        snapshot = self.snapshots.read_metadata(key)
+        seq = 0 if snapshot is None else snapshot.get("journal_seq", 0)
+        saves = self._saves(key, seq)
+        return saves[-1]["seq"] if len(saves) > 0 else seq
+
+    def _read(self, key: str, revision: int = None) -> tuple:
+        document = self.snapshots.read(key)
+        if document is None:
+            return None, 0, 0, 0
+        snapshot_seq = document.pop("journal_seq", 0)
+        saves = self._saves(key, snapshot_seq)
+        snapshot_size = self.snapshots.size(key) or 0
+        if revision is not None:
+            saves = [save for save in saves if save["seq"] <= revision]
+        seq = saves[-1]["seq"] if len(saves) > 0 else snapshot_seq
+        return replay(document, saves), seq, snapshot_seq, snapshot_size
+
+    def read(self, key: str, revision: int = None) -> dict | None:
+        # the session as of the given revision (the seq of a save), or the latest
+        # the version is checked first, so if the session is saved in the meantime, what's remembered is older
+        # than the version it's remembered with, and isn't used
+        version = self.version(key)
+        document, seq, snapshot_seq, snapshot_size = self._read(key, revision)
+        if document is None or revision is not None:
+            return document
+        # remember the document, so the next write only has to record what has changed since
+        journal = self._path(key)
+        with self._lock:
+            self._last[key] = (
+                _shadow(document),
+                seq,
+                snapshot_seq,
+                snapshot_size,
+                journal.stat().st_size if journal.exists() else 0,
+                version,
+            )
+        return document
+
+    def read_metadata(self, key: str) -> dict | None:
+        document = self.snapshots.read_metadata(key)
+        if document is None:
+            return None
+        saves = self._saves(key, document.pop("journal_seq", 0))
+        # series replaced by a save come with their data, which is taken out again
+        return split_blobs(replay(document, saves, metadata_only=True))[0]
+
+    def open(self, key: str) -> SessionReader | None:
+        # a session with nothing in its journal is just its snapshot, which can be read a blob at a time
+        snapshot = self.snapshots.read_metadata(key)
+        if snapshot is None:
+            return None
+        if len(self._saves(key, snapshot.get("journal_seq", 0))) > 0:
+            document = self.read(key)
+            return None if document is None else SessionReader(document)
+        reader = self.snapshots.open(key)
+        if reader is not None:
+            reader.document.pop("journal_seq", None)
+        return reader
+
+    def revisions(self, key: str) -> List[dict]:
+        # the saves since the last snapshot: their seq, when they were made, and the paths they changed
+        snapshot = self.snapshots.read_metadata(key)
+        if snapshot is None:
+            return []
+        return [
+            {
+                "seq": save["seq"],
+                "time": save["time"],
+                "paths": [
+                    list(p) for p in dict.fromkeys(tuple(op["path"]) for op in save["ops"]) if p != ("time",)
+                ],
+            }
+            for save in self._saves(key, snapshot.get("journal_seq", 0))
+        ]
+
+    def history(self, key: str) -> list:
+        # the snapshot's metadata and the values set by each save since, which between them hold every
+        # {"ref": key} the revisions of the session refer to
+        snapshot = self.snapshots.read_metadata(key)
+        if snapshot is None:
+            return []
+        values = [snapshot]
+        for save in self._saves(key, snapshot.get("journal_seq", 0)):
+            for op in save["ops"]:
+                # a changed ref is recorded as a set of the ref alone
+                values.append({"ref": op["value"]} if op["path"][-1:] == ["ref"] else op.get("value"))
+        return values
+
+    def _compact(self, key: str, document: dict, seq: int):
+        version = self.snapshots.write(key, document | {"journal_seq": seq})
+        # the snapshot includes everything in the journal now
+        self._path(key).unlink(missing_ok=True)
+        with self._lock:
+            self._last[key] = (_shadow(document), seq, seq, self.snapshots.size(key) or 0, 0, (version, None))
+        logging.info(f"Compacted the journal for {key}")
+        return (version, None)
+
+    def _ends_cleanly(self, key: str) -> bool:
+        # whether another save can be appended to the journal: it's empty, or its last save is complete
+        try:
+            with self._path(key).open("rb") as f:
+                if f.seek(0, os.SEEK_END) == 0:
+                    return True
+                f.seek(-1, os.SEEK_END)
+                return f.read(1) == b"\n"
+        except FileNotFoundError:
+            return True
+
+    def write(self, key: str, document: dict):
+        with self._lock:
+            last = self._last.get(key)
+        if last is None or last[5] != self.version(key):
+            # nothing to compare with yet (e.g. the first save since the server started), or it's been saved by
+            # another process since. The seq carries on from the journal, in case it outlives the new snapshot.
+            return self._compact(key, document, self._seq(key) + 1)
+        shadow, seq, snapshot_seq, snapshot_size, journal_size, _ = last
+        ops = diff(shadow, document)
+        if len(ops) == 0:
+            return self.version(key)
+        if any(op["path"] == ["data_series"] for op in ops):
+            # series were added or removed: the snapshot needs to know how many series there are, and most of
+            # the session is changing anyway
+            return self._compact(key, document, seq + 1)
+        line = json.dumps({"seq": seq + 1, "time": str(datetime.datetime.now()), "ops": ops}) + "\n"
+        if (
+            journal_size + len(line) > compaction_ratio * snapshot_size
+            or seq + 1 - snapshot_seq > max_journal_saves
+            or not self._ends_cleanly(key)
+        ):
+            return self._compact(key, document, seq + 1)
+        with self._path(key).open("a") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+            version = (self.snapshots.version(key), file_version(os.fstat(f.fileno())))
+        with self._lock:
+            self._last[key] = (
+                _shadow(document), seq + 1, snapshot_seq, snapshot_size, journal_size + len(line), version
+            )
+        return version
+
+    def version(self, key: str):
+        snapshot = self.snapshots.version(key)
+        if snapshot is None:
+            return None
+        try:
+            return (snapshot, file_version(self._path(key).stat()))
+        except FileNotFoundError:
+            return (snapshot, None)
+
+    def delete(self, key: str):
+        self.snapshots.delete(key)
+        self._path(key).unlink(missing_ok=True)
+        with self._lock:
+            self._last.pop(key, None)
+
+    def sessions(self) -> List[SessionInfo]:
+        # the journal counts towards the size of a session, and a save to it is a change to the session
+        infos = []
+        for info in self.snapshots.sessions():
+            try:
+                stat = self._path(info.key).stat()
+                info = SessionInfo(
+                    info.key,
+                    max(info.modified, stat.st_mtime),
+                    info.size + stat.st_size,
+                    info.series_count,
+                    (info.version, file_version(stat)),
+                )
+            except FileNotFoundError:
+                info = SessionInfo(info.key, info.modified, info.size, info.series_count, (info.version, None))
+            infos.append(info)
+        return infos
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.snapshots
+
+    def flush(self):
+        self.snapshots.flush()
+
+    def refresh(self):
+        self.snapshots.refresh()
@@ -0,0 +1,76 @@
+import logging
+import os
+from pathlib import Path
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # not on Windows, where each process only coordinates with itself
+    fcntl = None
+
+# Locks shared by every process using the same data directory, so that several replicas of the app can run
+# behind a load balancer with one data_cache volume. They're advisory flock locks on files in the directory: they
+# only keep out processes which take them too, and the OS releases them if the process holding them dies, so a
+# crash never leaves anything locked.
+
+
+class FileLock:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        # flock is per open file, but on some filesystems (e.g. NFS) it's emulated with locks which are per
+        # process, so the threads of a process are kept out of each other's way separately
+        self._thread_lock = threading.Lock()
+        self._fd = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if fcntl is None:
+            return True
+        fd = None
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            # held by another process
+            os.close(fd)
+            self._thread_lock.release()
+            return False
+        except BaseException:
+            if fd is not None:
+                os.close(fd)
+            self._thread_lock.release()
+            raise
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            # closing the file releases the lock
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class KeyLocks:
+    # A lock for each key (e.g. each session), shared between processes. Keys are spread over a fixed number of
+    # lock files, rather than one each, so the files never need cleaning up: removing a lock file while another
+    # process is waiting on it would let two processes hold "the same" lock. Keys which share a file just wait
+    # for each other now and then.
+    def __init__(self, directory: Path, stripes: int = 64):
+        self._locks = [FileLock(Path(directory) / f"{i:02x}.lock") for i in range(stripes)]
+        if fcntl is None:
+            logging.warning("File locking isn't available, so only one process can use the data directory safely")
+
+    def __call__(self, key: str) -> FileLock:
+        return self._locks[zlib.crc32(key.encode("utf-8")) % len(self._locks)]
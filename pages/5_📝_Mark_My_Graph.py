@@ -2,7 +2,7 @@
 import streamlit as st
 
 from marking import check_for_problems
-from persistence import get_existing_key, get_new_key, load_data
+from persistence import get_existing_key, get_new_key, load_data, tab_save_state
 import logging
 
 
@@ -38,7 +38,8 @@ try:
     if not "should_load" in st.session_state:
         st.session_state.should_load = True
     if st.session_state.should_load:
-        _data_series, _figure_properties, _csv_file = load_data(key)
+        # marking only needs the settings and the stats of each series, not the data itself
+        _data_series, _figure_properties, _csv_file = load_data(key, lazy=True, save_state=tab_save_state())
         st.session_state.data_series = _data_series
         st.session_state.figure_properties = _figure_properties
         st.session_state.csv_file = _csv_file
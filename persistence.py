@@ -1,4 +1,7 @@
-import json
+import atexit
+from dataclasses import dataclass
+import os
+import threading
 from typing import List
 import numpy as np
 import streamlit as st
@@ -8,7 +11,12 @@ import time
 import datetime
 import logging
 
-from data import CSVFile, DataSeries, FigureProperties
+from blobs import BlobStore
+from data import CSVFile, DataSeries, FigureProperties, state_fingerprint
+from journal import JournalStorage
+from locks import FileLock, KeyLocks
+from session_cache import SessionCache
+from storage import JSONStorage, SessionConflictError, SQLiteStorage, Storage
 from cookies import (
     get_cookie,
     has_cookie,
@@ -18,15 +26,50 @@ from cookies import (
 
 key_name = "physics_plotting_key"
 data_dir = Path("data_cache")
-if not data_dir.exists():
-    data_dir.mkdir()
+# several processes may be starting at once
+data_dir.mkdir(exist_ok=True)
+
+
+def make_storage(backend: str) -> Storage:
+    match backend:
+        case "json":
+            return JSONStorage(data_dir)
+        case "sqlite":
+            return SQLiteStorage(data_dir / "sessions.db")
+        case _:
+            raise ValueError(f"Unknown storage backend: {backend}")
+
+
+# "json" (the default) for a directory of JSON files, or "sqlite" for a single database. See storage.py.
+storage = make_storage(os.environ.get("PLOTTING_STORAGE", "json"))
+# With PLOTTING_JOURNAL=1, each save only appends what changed to a journal, and the session is rewritten in full
+# now and then. This also keeps the recent versions of each session, which can be restored. See journal.py.
+if os.environ.get("PLOTTING_JOURNAL", "0") == "1":
+    storage = JournalStorage(storage, data_dir / "journals")
+
+# data_dir can be shared by several processes (e.g. replicas behind a load balancer). Each session is only written
+# or deleted while holding its lock, and is only written if it's still the version this process last read or
+# wrote, so a save made by another process in the meantime is detected rather than silently overwritten.
+session_locks = KeyLocks(data_dir / "locks")
+
+# The sessions this process has loaded or saved most recently are kept in memory, up to this many bytes, so
+# that changing pages or reconnecting doesn't need to read them from storage again. See session_cache.py.
+live_cache_bytes = 256 * (1 << 20)
+live_sessions = SessionCache(live_cache_bytes)
+
+# Uploaded CSV files are stored once each, by content, however many sessions use them, along with the tables they
+# were parsed into. Sessions only refer to them. See blobs.py.
+blob_store = BlobStore(data_dir / "blobs")
+
+# Series larger than this (in bytes of data) are moved out of RAM into memory-mapped files in the session's
+# storage area. Set with PLOTTING_SPILL_BYTES; 0 or an empty value disables spilling altogether (None).
+spill_threshold = int(os.environ.get("PLOTTING_SPILL_BYTES", 16 * (1 << 20)) or 0) or None
 
-all_keys = [f.stem for f in data_dir.glob("*.json")]
 all_cookies = None
 
 
 def key_in_use(key):
-    return key in all_keys
+    return key in storage
 
 
 def generate_uuid() -> str:
@@ -106,61 +149,503 @@ def state_to_json(data_series, figure_properties, csv_file=None):
     }
 
 
-def load_data(key):
-    data_file = data_dir / f"{key}.json"
-    if not data_file.exists():
-        # create it as an empty json file
+# Saves are skipped when nothing has changed since the last one, and are otherwise handed to a background writer,
+# so the script thread never waits on the disk. A save only serialises the state; the writer does the rest. Each
+# session is written at most once per save_interval seconds, and if it changes again while waiting, the waiting
+# save is replaced, so several saves are coalesced into one write of the latest state.
+save_interval = 2.0
 
-        data = state_to_json([], FigureProperties.default())
-        # json.dump(data, data_file.open("w"))
-    else:
-        data = json.load(data_file.open())
-    series = [DataSeries.from_dict(d) for d in data["data_series"]]
+_save_lock = threading.Lock()
+_save_ready = threading.Condition(_save_lock)
+# held for the whole of each write, so that writes of the same session can never land out of order
+_write_lock = threading.Lock()
+# (key, SaveState) -> (time it's due to be written, document, blobs) waiting for the writer
+_pending = {}
+_last_write = {}  # key -> time.monotonic() of the last write
+_writer = None
+
+# the version of a session nothing has been read or written from yet (None is a session which doesn't exist)
+_unknown = object()
+
+
+class SaveState:
+    # What one copy of a session (one browser tab, see tab_save_state) knows about saving it: the fingerprint of
+    # the state last saved or loaded, so unchanged state isn't saved again, and the version of the session that
+    # was (see Storage.version). A save is only written if the session is still that version, so a tab which has
+    # fallen behind another tab, in this process or any other, can't silently overwrite it.
+    def __init__(self):
+        self.fingerprint = None
+        self.version = _unknown
+        self.conflict = False  # a save was rejected, and the session should be loaded again
+
+
+def tab_save_state() -> SaveState:
+    # the SaveState of this browser tab, shared by all of its pages
+    if "save_state" not in st.session_state:
+        st.session_state.save_state = SaveState()
+    return st.session_state.save_state
+
+
+@dataclass
+class SaveMetrics:
+    saves: int = 0  # saves handed to the writer
+    coalesced: int = 0  # saves which replaced one already waiting
+    writes: int = 0
+    failures: int = 0
+    conflicts: int = 0  # writes rejected because another process had saved the session first
+    total_latency: float = 0.0  # seconds spent writing
+    max_latency: float = 0.0
+
+    @property
+    def coalescing_ratio(self) -> float:
+        # the fraction of saves which didn't need a write of their own
+        return 0.0 if self.saves == 0 else self.coalesced / self.saves
+
+    @property
+    def mean_latency(self) -> float:
+        return 0.0 if self.writes == 0 else self.total_latency / self.writes
+
+    def summary(self, queue_depth: int) -> str:
+        return (
+            f"{queue_depth} queued, {self.writes} written ({self.failures} failed, {self.conflicts} conflicts), "
+            f"{self.coalescing_ratio:.0%} of {self.saves} saves coalesced, "
+            f"write latency {self.mean_latency * 1000:.1f} ms mean, {self.max_latency * 1000:.1f} ms max"
+        )
+
+
+_metrics = SaveMetrics()
+# how often (in writes) the writer logs its metrics
+metrics_log_interval = 100
+
+
+def save_metrics() -> dict:
+    with _save_lock:
+        return {
+            "queue_depth": len(_pending),
+            "saves": _metrics.saves,
+            "coalesced": _metrics.coalesced,
+            "coalescing_ratio": _metrics.coalescing_ratio,
+            "writes": _metrics.writes,
+            "failures": _metrics.failures,
+            "conflicts": _metrics.conflicts,
+            "mean_latency": _metrics.mean_latency,
+            "max_latency": _metrics.max_latency,
+        }
+
+
+def save_metrics_summary() -> str:
+    with _save_lock:
+        return _metrics.summary(len(_pending))
+
+
+def session_fingerprint(data_series, figure_properties, csv_file=None) -> str:
+    return state_fingerprint(data_series, figure_properties) + (
+        "" if csv_file is None else csv_file.fingerprint()
+    )
+
+
+def _write(key, document, blobs, save_state: SaveState):
+    # called with _write_lock held. blobs (digest -> contents) are put in the blob store first, since the document
+    # refers to them.
+    start = time.perf_counter()
+    try:
+        for digest, contents in (blobs or {}).items():
+            blob_store.put(contents.encode("utf-8"), digest)
+        with session_locks(key):
+            with _save_lock:
+                expected = save_state.version
+            # If nothing has been read or written from this copy of the session, there's nothing to compare with. A session
+            # which has gone has been deleted (e.g. swept) rather than saved elsewhere, so nothing would be lost by
+            # saving it again.
+            current = storage.version(key)
+            if expected is not _unknown and current is not None and current != expected:
+                raise SessionConflictError(f"Session {key} has been saved elsewhere since it was loaded")
+            version = storage.write(key, document)
+    except SessionConflictError as e:
+        logging.warning(f"Not saving {key}: {e}")
+        with _save_lock:
+            _metrics.conflicts += 1
+            save_state.conflict = True
+            save_state.fingerprint = None
+        return
+    except Exception as e:
+        logging.error(f"Error saving data for {key}: {e}")
+        with _save_lock:
+            _metrics.failures += 1
+            # make sure the next save isn't skipped as unchanged
+            save_state.fingerprint = None
+        return
+    latency = time.perf_counter() - start
+    with _save_lock:
+        _last_write[key] = time.monotonic()
+        save_state.version = version
+        _metrics.writes += 1
+        _metrics.total_latency += latency
+        _metrics.max_latency = max(_metrics.max_latency, latency)
+        if _metrics.writes % metrics_log_interval == 0:
+            logging.info(f"Saves: {_metrics.summary(len(_pending))}")
+    # the document isn't needed for anything else now, so it can be handed to the cache
+    live_sessions.put(key, version, document)
+    logging.info(f"Saved data for {key}")
+
+
+def _write_forever():
+    while True:
+        with _save_ready:
+            while True:
+                now = time.monotonic()
+                due = min(_pending, key=lambda k: _pending[k][0], default=None)
+                if due is not None and _pending[due][0] <= now:
+                    break
+                # wait for the next save to come due, or for a new one
+                _save_ready.wait(None if due is None else _pending[due][0] - now)
+        with _write_lock:
+            # it may have been flushed (or cleared) in the meantime
+            with _save_lock:
+                pending = _pending.pop(due, None)
+            if pending is not None:
+                _write(due[0], *pending[1:], due[1])
+
+
+def _forget_idle():
+    # A session's last write only matters for save_interval afterwards, so sessions idle for longer are
+    # forgotten. Otherwise every key this process has ever saved would be kept for as long as it runs.
+    now = time.monotonic()
+    with _save_lock:
+        for key in [key for key, last in _last_write.items() if now - last > save_interval]:
+            del _last_write[key]
+
+
+def _start_writer():
+    # called with _save_lock held
+    global _writer
+    if _writer is None:
+        _writer = threading.Thread(target=_write_forever, name="session-writer", daemon=True)
+        _writer.start()
+
+
+def _loader(reader=None):
+    # reads what a document refers to: {"ref": key} from the blob store, or {"blob": i} from reader (a
+    # storage.SessionReader)
+    def load(ref: dict) -> bytes:
+        if "ref" in ref:
+            return blob_store.get(ref["ref"])
+        return reader.blob(ref["blob"])
+
+    return load
+
+
+def _state_from_json(data, reader=None):
+    load = _loader(reader)
+    series = [DataSeries.from_dict(d, load) for d in data["data_series"]]
     figure_properties = FigureProperties.from_dict(data["figure_properties"])
     csv_file = (
         None
         if ("csv_file" not in data or data["csv_file"] is None)
-        else CSVFile.from_dict(data["csv_file"])
+        else CSVFile.from_dict(data["csv_file"], load)
     )
     return series, figure_properties, csv_file
 
 
+def load_data(key, lazy=False, save_state: SaveState = None):
+    # With lazy, only the settings are read now. The data of each series and the contents of the CSV file are
+    # read from storage the first time they're used, so a page which only needs the settings (and the stats
+    # saved with each series) loads in the same time however much data there is.
+    # save_state is that of the copy of the session being loaded into, which is then in step with storage.
+    # anything still waiting to be written is newer than what's in storage
+    flush_data(key)
+    # the version is checked before reading, so if the session is saved in the meantime, what's cached is
+    # older than the version it's cached under, and won't be used again
+    version = storage.version(key)
+    data, reader = live_sessions.get(key, version), None
+    if data is not None:
+        # nothing to read, so nothing to gain from loading lazily
+        lazy = False
+    elif lazy:
+        reader = storage.open(key)
+        data = None if reader is None else reader.document
+    else:
+        data = storage.read(key)
+        if data is not None:
+            live_sessions.put(key, version, data)
+    if data is None:
+        data = state_to_json([], FigureProperties.default())
+    series, figure_properties, csv_file = _state_from_json(data, reader)
+    # the loaded state is already saved, so there's no need to write it again until it changes. Working out the
+    # fingerprint would need all of the data, so the one it was saved with is used when there is one.
+    if save_state is not None:
+        with _save_lock:
+            save_state.version = version
+            save_state.conflict = False
+            if "fingerprint" in data:
+                save_state.fingerprint = data["fingerprint"]
+            elif not lazy:
+                save_state.fingerprint = session_fingerprint(series, figure_properties, csv_file)
+            else:
+                save_state.fingerprint = None
+    return series, figure_properties, csv_file
+
+
+def _session_document(data_series, figure_properties, csv_file=None):
+    # the document to write, and the blobs (digest -> contents) to put in the blob store first. The session only
+    # refers to the contents of its CSV file.
+    document = state_to_json(data_series, figure_properties, csv_file)
+    blobs = {}
+    if csv_file is not None:
+        digest = csv_file.content_digest()
+        blobs[digest] = document["csv_file"]["contents"]
+        document["csv_file"]["contents"] = {"ref": digest}
+    return document, blobs
+
+
 def save_data(
     key,
     data_series: List[DataSeries],
     figure_properties: FigureProperties,
     csv_file=None,
+    save_state: SaveState = None,
 ):
-    data = state_to_json(data_series, figure_properties, csv_file)
-    data_file = data_dir / f"{key}.json"
-    json.dump(data, data_file.open("w"))
+    # save_state is that of the copy of the session being saved. Without one, the save is always written, over
+    # whatever is in storage.
+    if save_state is None:
+        save_state = SaveState()
+    fingerprint = session_fingerprint(data_series, figure_properties, csv_file)
+    with _save_lock:
+        if fingerprint == save_state.fingerprint:
+            return
+    # serialise now, since the state objects will carry on changing before the write happens
+    document, blobs = _session_document(data_series, figure_properties, csv_file)
+    document["fingerprint"] = fingerprint
+    with _save_ready:
+        save_state.fingerprint = fingerprint
+        _metrics.saves += 1
+        if (key, save_state) in _pending:
+            # still waiting, so just replace what will be written
+            _metrics.coalesced += 1
+            _pending[key, save_state] = (_pending[key, save_state][0], document, blobs)
+            return
+        _pending[key, save_state] = (_last_write.get(key, -save_interval) + save_interval, document, blobs)
+        _start_writer()
+        _save_ready.notify()
 
 
-def clear_data(key):
-    data_file = data_dir / f"{key}.json"
-    try:
-        data_file.unlink()
-    except FileNotFoundError:
-        logging.warning(f"Could not find file {data_file} when clearing data")
-    # create the empty file again
-    data = state_to_json([], FigureProperties.default())
-    json.dump(data, data_file.open("w"))
+def flush_data(key=None):
+    # write any pending saves (for one key, or all of them) straight away, in this thread
+    with _write_lock:
+        with _save_lock:
+            documents = [
+                (k, *_pending.pop((k, save_state))[1:], save_state)
+                for k, save_state in list(_pending)
+                if key is None or k == key
+            ]
+        for k, document, blobs, save_state in documents:
+            _write(k, document, blobs, save_state)
+
+
+def _shutdown():
+    flush_data()
+    logging.info(f"Saves: {save_metrics_summary()}")
+
+
+# don't lose changes which were still waiting to be written when the server stops. atexit runs the last handler
+# registered first, so the storage is flushed after the pending saves have been written to it.
+atexit.register(storage.flush)
+atexit.register(_shutdown)
+
+
+def clear_data(key, save_state: SaveState):
+    with _write_lock:
+        with _save_lock:
+            # anything this copy was waiting to save is now out of date
+            _pending.pop((key, save_state), None)
+            save_state.fingerprint = None
+        # overwrite the session with an empty one
+        _write(key, state_to_json([], FigureProperties.default()), None, save_state)
     st.session_state.should_load = True
 
 
-def time_since_last_edit(key):
-    data_file = data_dir / f"{key}.json"
-    if not data_file.exists():
-        return None
-    data = json.load(data_file.open())
-    t = datetime.datetime.strptime(data["time"], "%Y-%m-%d %H:%M:%S.%f")
-    return datetime.datetime.now() - t
+def take_conflict(save_state: SaveState) -> bool:
+    # whether a save has been rejected (see _write) since this was last asked, because the session had been saved
+    # from somewhere else first. The session should then be loaded again, to pick up that save.
+    with _save_lock:
+        conflict = save_state.conflict
+        save_state.conflict = False
+        return conflict
+
+
+def journal_enabled() -> bool:
+    return isinstance(storage, JournalStorage)
+
+
+def session_revisions(key) -> list:
+    # the earlier versions of the session which can be restored, newest first
+    if not journal_enabled():
+        return []
+    return storage.revisions(key)[::-1]
+
+
+def restore_revision(key, revision, save_state: SaveState):
+    flush_data(key)
+    with _write_lock:
+        data = storage.read(key, revision=revision)
+        if data is None:
+            return
+        # saved as a new version, so restoring can itself be undone by restoring the version before it
+        _write(key, *_session_document(*_state_from_json(data)), save_state)
+        with _save_lock:
+            save_state.fingerprint = None
+    logging.info(f"Restored version {revision} of {key}")
+    st.session_state.should_load = True
+
+
+def parse_csv(csv_file: CSVFile) -> np.array:
+    # The file's contents parsed into a table of strings, with its current options. Each file is only parsed once
+    # with each set of options, whichever session it's in, since the table (and its numeric values) are kept in
+    # the blob store alongside the contents.
+    options = csv_file.parse_options()
+    if csv_file.parsed_with(options):
+        return csv_file.data
+    digest = csv_file.content_digest()
+    arrays = blob_store.get_arrays(digest, options, ["table", "numeric"])
+    if arrays is not None:
+        csv_file.set_data(arrays["table"], arrays["numeric"], options)
+        return csv_file.data
+    table = csv_file.parse()
+    csv_file.set_data(table, options=options)
+    if table.ndim == 2:
+        # anything else is an error, which isn't worth keeping
+        try:
+            blob_store.put_arrays(digest, options, {"table": table, "numeric": csv_file.numeric_data()})
+        except OSError as e:
+            logging.error(f"Error storing parsed CSV file {digest}: {e}")
+    return table
+
+
+def array_dir(key) -> Path:
+    # where the memory-mapped arrays of a session live
+    return data_dir / "arrays" / key
+
+
+def spill_large_series(key, data_series: List[DataSeries]):
+    if spill_threshold is None:
+        return
+    for s in data_series:
+        if not s.spilled and s.memory_usage()["data"] > spill_threshold:
+            logging.info(f"Moving data series {s.name} ({len(s)} rows) to memory-mapped storage")
+            s.spill(array_dir(key))
+
+
+# Saved sessions are removed once they haven't been changed for session_ttl, or for empty_session_ttl if they
+# have no data (which leaves time for a session just cleared to be filled again). If the sessions still take up
+# more than max_total_bytes, the least recently changed are removed until they don't. Whatever they leave of
+# max_total_bytes is the limit for the blob store, which gives up parsed CSV tables to stay under it.
+session_ttl = datetime.timedelta(days=30)
+empty_session_ttl = datetime.timedelta(hours=1)
+max_total_bytes = 1 << 30  # 1 GiB
+sweep_interval = 60 * 60  # seconds
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def delete_session(key, version=None) -> bool:
+    # With a version, the session is only deleted if it's still that version, i.e. it hasn't been saved (by
+    # any process) since. Returns whether it was deleted.
+    with session_locks(key):
+        if version is not None and storage.version(key) != version:
+            return False
+        storage.delete(key)
+    live_sessions.invalidate(key)
+    with _save_lock:
+        _last_write.pop(key, None)
+    arrays = array_dir(key)
+    if arrays.exists():
+        # mapped arrays are normally removed as soon as they're unused, but some platforms can't do that
+        for f in arrays.iterdir():
+            f.unlink(missing_ok=True)
+        arrays.rmdir()
+    return True
+
+
+def sweep():
+    # pick up sessions saved by other processes
+    storage.refresh()
+    now = time.time()
+    # each session is only removed if it hasn't been saved since it was listed, by this process or any other
+    expired = [
+        info
+        for info in storage.sessions()
+        if now - info.modified > (empty_session_ttl if info.series_count == 0 else session_ttl).total_seconds()
+    ]
+    removed = sum(delete_session(info.key, info.version) for info in expired)
+    remaining = sorted(storage.sessions(), key=lambda info: info.modified)
+    total = sum(info.size for info in remaining)
+    evicted = 0
+    for info in remaining:
+        if total <= max_total_bytes:
+            break
+        if delete_session(info.key, info.version):
+            total -= info.size
+            evicted += 1
+    sweep_blobs(max(0, max_total_bytes - total))
+    storage.flush()
+    if removed > 0 or evicted > 0:
+        logging.info(f"Removed {removed} expired and {evicted} least recently used sessions")
+
+
+def _find_refs(value, refs: set):
+    # adds the key of every {"ref": key} in value (a document, or part of one) to refs
+    if isinstance(value, dict):
+        if isinstance(value.get("ref"), str):
+            refs.add(value["ref"])
+        for v in value.values():
+            _find_refs(v, refs)
+    elif isinstance(value, list):
+        for v in value:
+            _find_refs(v, refs)
+
+
+def sweep_blobs(max_bytes: int = None):
+    # removes the CSV files which no session refers to any more, including its earlier revisions
+    live = set()
+    for info in storage.sessions():
+        if journal_enabled():
+            _find_refs(storage.history(info.key), live)
+        else:
+            _find_refs(storage.read_metadata(info.key), live)
+    with _save_lock:
+        # and those waiting to be written
+        live.update(digest for _, _, blobs in _pending.values() for digest in blobs)
+    blob_store.sweep(live, max_bytes=max_bytes)
+
+
+# However many processes share data_dir, only one sweeps: whichever holds the sweeper lease. The others try to
+# take it over each sweep_interval, which they can once the process holding it has stopped.
+_sweeper_lease = FileLock(data_dir / "locks" / "sweeper.lock")
+
+
+def _sweep_forever():
+    elected = False
+    while True:
+        if not elected:
+            elected = _sweeper_lease.acquire(blocking=False)
+            if elected:
+                logging.info("This process is now sweeping old sessions")
+        if elected:
+            try:
+                sweep()
+            except Exception as e:
+                logging.error(f"Error sweeping old sessions: {e}")
+        _forget_idle()
+        logging.info(f"Saves: {save_metrics_summary()}")
+        logging.info(f"Live sessions: {live_sessions.summary()}")
+        time.sleep(sweep_interval)
 
 
-def clean_old_files():
-    for f in data_dir.glob("*.json"):
-        if time_since_last_edit(f.stem) > datetime.timedelta(days=30):
-            f.unlink()
-        series, figure_properties, csv_file = load_data(f.stem)
-        if len(series) == 0:
-            f.unlink()
+def start_sweeper():
+    # one sweeper thread per process, started by the first session (though only one process sweeps)
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=_sweep_forever, name="session-sweeper", daemon=True)
+            _sweeper.start()
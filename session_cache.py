@@ -0,0 +1,116 @@
+import base64
+from collections import OrderedDict
+from dataclasses import dataclass
+import threading
+
+# The sessions most recently loaded or saved by this process, kept in memory so that switching pages or
+# reconnecting doesn't read them from storage again. Each session is kept as its document, as written to storage,
+# but with the data of each series decoded to raw bytes. Loading a session from the cache then costs no I/O,
+# decompression or decoding: each DataSeries wraps its bytes as a read-only array (see decode_array), which it
+# only copies if it's edited, so the cached bytes are never changed and can be shared by every session which
+# loads them.
+#
+# An entry is only used if the session in storage is still the version it was cached from (see Storage.version),
+# so a session saved by another process is never served stale. The cache is limited to max_bytes, with the least
+# recently used sessions dropped first.
+
+
+def _decode(document: dict) -> dict:
+    # base64 is replaced by bytes, changing document in place
+    for series in document["data_series"]:
+        data = series.get("data")
+        if isinstance(data, dict) and "base64" in data:
+            data["bytes"] = base64.b64decode(data.pop("base64"))
+    return document
+
+
+def _nbytes(document: dict) -> int:
+    nbytes = 0
+    for series in document["data_series"]:
+        data = series.get("data")
+        if isinstance(data, dict) and "bytes" in data:
+            nbytes += len(data["bytes"])
+    csv_file = document.get("csv_file")
+    if csv_file is not None and isinstance(csv_file.get("contents"), str):
+        nbytes += len(csv_file["contents"])
+    # the rest of the document is small, but isn't free
+    return nbytes + 1024 * (1 + len(document["data_series"]))
+
+
+@dataclass
+class CacheMetrics:
+    hits: int = 0
+    misses: int = 0
+    stale: int = 0  # misses because the session had been saved elsewhere since it was cached
+    evictions: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return 0.0 if lookups == 0 else self.hits / lookups
+
+
+class SessionCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (version, document, nbytes), least recently used first
+        self._nbytes = 0
+        self.metrics = CacheMetrics()
+
+    def get(self, key: str, version) -> dict | None:
+        # the cached document for the session, if it's for this version. The document mustn't be changed.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or version is None or entry[0] != version:
+                self.metrics.misses += 1
+                if entry is not None:
+                    self.metrics.stale += 1
+                    self._remove(key)
+                return None
+            self.metrics.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: str, version, document: dict):
+        # document becomes the cache's, and mustn't be changed afterwards
+        if version is None:
+            return
+        document = _decode(document)
+        nbytes = _nbytes(document)
+        with self._lock:
+            self._remove(key)
+            if nbytes > self.max_bytes:
+                # larger than the whole cache
+                return
+            self._entries[key] = (version, document, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.metrics.evictions += 1
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: str):
+        # called with _lock held
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._nbytes -= entry[2]
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def summary(self) -> str:
+        with self._lock:
+            return (
+                f"{len(self._entries)} sessions, {self._nbytes / (1 << 20):.1f} of {self.max_bytes / (1 << 20):.0f} MiB, "
+                f"{self.metrics.hit_ratio:.0%} of {self.metrics.hits + self.metrics.misses} loads hit "
+                f"({self.metrics.stale} stale), {self.metrics.evictions} evicted"
+            )
@@ -0,0 +1,622 @@
+from abc import ABC, abstractmethod
+import argparse
+import base64
+from contextlib import contextmanager
+from dataclasses import dataclass
+import gzip
+import importlib.util
+import json
+import logging
+import os
+from pathlib import Path
+import queue
+import sqlite3
+import struct
+import threading
+import time
+from typing import List
+
+# Where saved sessions are kept. persistence.py only deals with a Storage, so the backend can be swapped
+# without touching the rest of the app:
+#  - JSONStorage keeps one JSON file per session in a directory. It needs no setup, and suits small installs.
+#  - SQLiteStorage keeps every session in one SQLite database, with the metadata the sweeper needs in columns
+#    of their own and the series data and CSV contents stored as compressed BLOBs.
+# A session is stored as the document produced by persistence.state_to_json.
+#
+# To move an existing JSON install over to SQLite, run
+#     python storage.py data_cache data_cache/sessions.db
+
+
+def file_version(stat: os.stat_result) -> tuple:
+    # identifies one version of a file. Files are replaced rather than rewritten (see write_atomic), so a new
+    # version is a new inode, even if it's the same size and written within the resolution of the clock.
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def write_atomic(path: Path, content: str | bytes) -> os.stat_result:
+    # write to a temporary file alongside, then rename it over the original. A crash part way through leaves
+    # either the old file or the new one, never a truncated mixture. Returns the stat of the file written.
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with tmp.open("wb" if isinstance(content, bytes) else "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+            stat = os.fstat(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+    # make the rename itself durable
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(path.parent, os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    return stat
+
+
+# Sessions are stored compressed. The bulky parts of a session (the data of each series, and the contents of
+# an uploaded CSV file) are taken out of the document as blobs and compressed separately, and the rest of the
+# document, which is small, is kept uncompressed. Reading just the metadata (e.g. to count the series) then
+# never has to decompress anything. A packed session is laid out as:
+#     magic (8 bytes) | metadata length (uint32, little-endian) | metadata (JSON) | blob | blob | ...
+# where the metadata is the document with each blob replaced by {"blob": i}, plus a table of where each blob is
+# and how it was compressed. Anything without the magic header is an older, plain JSON session.
+magic = b"PLTSESS1"
+# zstd where it's installed, gzip otherwise. Either is always readable, as long as the module is available.
+compression_codec = "zstd" if importlib.util.find_spec("zstandard") is not None else "gzip"
+# blobs smaller than this aren't worth compressing
+min_compressed_size = 256
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    match codec:
+        case "zstd":
+            import zstandard
+
+            return zstandard.ZstdCompressor(level=3).compress(data)
+        case "gzip":
+            return gzip.compress(data, compresslevel=6)
+        case "none":
+            return data
+        case _:
+            raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    match codec:
+        case "zstd":
+            import zstandard
+
+            return zstandard.ZstdDecompressor().decompress(data)
+        case "gzip":
+            return gzip.decompress(data)
+        case "none":
+            # a copy, rather than a view which would keep the rest of the session in memory
+            return bytes(data)
+        case _:
+            raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def split_blobs(document: dict) -> tuple:
+    # returns a copy of the document with the bulky values replaced by {"blob": i}, and the list of blobs (bytes).
+    # The document passed in isn't changed.
+    document = dict(document)
+    blobs = []
+
+    def take(data: bytes) -> dict:
+        blobs.append(data)
+        return {"blob": len(blobs) - 1}
+
+    document["data_series"] = [dict(series) for series in document["data_series"]]
+    for series in document["data_series"]:
+        data = series.get("data")
+        if isinstance(data, dict) and "base64" in data:
+            series["data"] = {k: v for k, v in data.items() if k != "base64"} | take(base64.b64decode(data["base64"]))
+    if document.get("csv_file") is not None and isinstance(document["csv_file"].get("contents"), str):
+        document["csv_file"] = dict(document["csv_file"])
+        document["csv_file"]["contents"] = take(document["csv_file"]["contents"].encode("utf-8"))
+    return document, blobs
+
+
+def join_blobs(document: dict, blobs: list) -> dict:
+    # the inverse of split_blobs, changing document in place. Array data is handed back as bytes (see decode_array).
+    for series in document["data_series"]:
+        data = series.get("data")
+        if isinstance(data, dict) and "blob" in data:
+            data["bytes"] = blobs[data.pop("blob")]
+    contents = None if document.get("csv_file") is None else document["csv_file"].get("contents")
+    if isinstance(contents, dict) and "blob" in contents:
+        document["csv_file"]["contents"] = blobs[contents["blob"]].decode("utf-8")
+    return document
+
+
+def _compress_blobs(blobs: list) -> list:
+    codecs = [compression_codec if len(blob) >= min_compressed_size else "none" for blob in blobs]
+    return [(codec, compress(blob, codec)) for codec, blob in zip(codecs, blobs)]
+
+
+def pack_session(document: dict) -> bytes:
+    metadata, blobs = split_blobs(document)
+    compressed = _compress_blobs(blobs)
+    table = []
+    offset = 0
+    for codec, data in compressed:
+        table.append({"codec": codec, "offset": offset, "length": len(data)})
+        offset += len(data)
+    metadata = json.dumps({"document": metadata, "blobs": table}).encode("utf-8")
+    return b"".join([magic, struct.pack("<I", len(metadata)), metadata, *(data for _, data in compressed)])
+
+
+def is_packed(raw: bytes) -> bool:
+    return raw[: len(magic)] == magic
+
+
+def unpack_session(raw: bytes, metadata_only: bool = False) -> dict:
+    if not is_packed(raw):
+        # an older, uncompressed session
+        return json.loads(raw)
+    start = len(magic) + 4
+    (length,) = struct.unpack("<I", raw[len(magic) : start])
+    metadata = json.loads(raw[start : start + length])
+    if metadata_only:
+        return metadata["document"]
+    view = memoryview(raw)[start + length :]
+    blobs = [
+        decompress(view[b["offset"] : b["offset"] + b["length"]], b["codec"])
+        for b in metadata["blobs"]
+    ]
+    return join_blobs(metadata["document"], blobs)
+
+
+def _read_packed_metadata(f) -> tuple:
+    # reads just the header and metadata of a packed session from the file f, leaving it positioned at the first
+    # blob. Returns the metadata, or None and the whole file if it isn't a packed session.
+    head = f.read(len(magic) + 4)
+    if not is_packed(head):
+        return None, head + f.read()
+    (length,) = struct.unpack("<I", head[len(magic) :])
+    return json.loads(f.read(length)), None
+
+
+def read_session_metadata(path: Path) -> dict:
+    # only the header and metadata are read from the file, not the blobs
+    with path.open("rb") as f:
+        metadata, raw = _read_packed_metadata(f)
+    return json.loads(raw) if metadata is None else metadata["document"]
+
+
+class StaleSessionError(Exception):
+    # the session was changed (or deleted) after it was opened, so its blobs no longer match its metadata
+    pass
+
+
+class SessionConflictError(Exception):
+    # the session was saved by another process since this one last read or wrote it, so writing it would
+    # overwrite that save
+    pass
+
+
+class SessionReader:
+    # A session opened for reading. The document is available straight away, but with the bulky values replaced
+    # by {"blob": i} (as from read_metadata), and each blob is only read when it's asked for, from the same
+    # version of the session as the document. Backends which can't do this give the full document, with no blobs.
+    def __init__(self, document: dict, read_blob=None):
+        self.document = document
+        self._read_blob = read_blob
+
+    def blob(self, i: int) -> bytes:
+        return self._read_blob(i)
+
+
+@dataclass
+class SessionInfo:
+    key: str
+    modified: float  # seconds since the epoch
+    size: int  # bytes
+    series_count: int
+    # the version of the session (see Storage.version) this describes, if known
+    version: object = None
+
+    def to_dict(self):
+        return {
+            "key": self.key,
+            "modified": self.modified,
+            "size": self.size,
+            "series_count": self.series_count,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(
+            key=d["key"],
+            modified=d["modified"],
+            size=d["size"],
+            series_count=d["series_count"],
+        )
+
+
+class Storage(ABC):
+    # The interface every backend provides. Keys are the session keys from the cookies.
+
+    @abstractmethod
+    def read(self, key: str) -> dict | None:
+        # the session's document, or None if there isn't one
+        ...
+
+    @abstractmethod
+    def read_metadata(self, key: str) -> dict | None:
+        # the session's document without the series data or CSV contents, which is much cheaper to read
+        ...
+
+    def open(self, key: str) -> SessionReader | None:
+        # the session for reading its blobs one at a time (see SessionReader), or None if there isn't one
+        document = self.read(key)
+        return None if document is None else SessionReader(document)
+
+    @abstractmethod
+    def write(self, key: str, document: dict):
+        # returns the version of the session that was written (see version)
+        ...
+
+    @abstractmethod
+    def version(self, key: str):
+        # A token which changes whenever the session is written, and is cheap to get: no more than a stat or an
+        # indexed lookup. None if there is no session.
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    def sessions(self) -> List[SessionInfo]:
+        # metadata for every stored session, without reading the sessions themselves
+        ...
+
+    @abstractmethod
+    def __contains__(self, key: str) -> bool:
+        ...
+
+    def size(self, key: str) -> int | None:
+        # the bytes the session takes up in storage, or None if there is no session
+        for info in self.sessions():
+            if info.key == key:
+                return info.size
+        return None
+
+    def flush(self):
+        # persist anything the backend is holding in memory
+        pass
+
+    def refresh(self):
+        # bring anything the backend is holding in memory up to date with changes made by other processes
+        pass
+
+
+class SessionIndex:
+    # A small record of every saved session, kept up to date as sessions are saved, so that looking up keys and
+    # sweeping out old sessions never has to open the session files themselves. It is kept in memory and written
+    # to path by the sweeper (and at exit). On start up it is checked against the directory, which only needs a
+    # stat of each file; a session file is only read if the index doesn't know about it yet.
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._dirty = False
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._sessions
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def sessions(self) -> List[SessionInfo]:
+        with self._lock:
+            return list(self._sessions.values())
+
+    def update(self, key, stat: os.stat_result, series_count: int):
+        with self._lock:
+            self._sessions[key] = SessionInfo(key, stat.st_mtime, stat.st_size, series_count, file_version(stat))
+            self._dirty = True
+
+    def remove(self, key):
+        with self._lock:
+            if self._sessions.pop(key, None) is not None:
+                self._dirty = True
+
+    def load(self, directory: Path):
+        sessions = {}
+        if self.path.exists():
+            try:
+                sessions = {d["key"]: SessionInfo.from_dict(d) for d in json.loads(self.path.read_text())}
+            except Exception as e:
+                logging.warning(f"Could not read the session index, rebuilding it: {e}")
+        # bring the index up to date with the files that are actually there
+        found = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json") or not entry.is_file() or entry.path == str(self.path):
+                    continue
+                key = entry.name[: -len(".json")]
+                try:
+                    # not entry.stat(), which has no inode on Windows, so wouldn't give the same version
+                    stat = os.stat(entry.path)
+                except FileNotFoundError:
+                    # deleted by another process in the meantime
+                    continue
+                info = sessions.get(key)
+                if info is None or info.modified != stat.st_mtime or info.size != stat.st_size:
+                    try:
+                        series_count = len(read_session_metadata(Path(entry.path))["data_series"])
+                    except Exception:
+                        series_count = 0
+                else:
+                    series_count = info.series_count
+                found[key] = SessionInfo(key, stat.st_mtime, stat.st_size, series_count, file_version(stat))
+        with self._lock:
+            self._sessions = found
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            text = json.dumps([info.to_dict() for info in self._sessions.values()])
+            self._dirty = False
+        write_atomic(self.path, text)
+
+
+class JSONStorage(Storage):
+    # One file per session, named after the key. The files are still named .json, as they always have been, but
+    # are now packed sessions (see pack_session); older files in plain JSON are still read.
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.index = SessionIndex(self.directory / "index.json")
+        self.index.load(self.directory)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def read(self, key: str) -> dict | None:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        return unpack_session(path.read_bytes())
+
+    def read_metadata(self, key: str) -> dict | None:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        return read_session_metadata(path)
+
+    def open(self, key: str) -> SessionReader | None:
+        path = self._path(key)
+        try:
+            with path.open("rb") as f:
+                version = file_version(os.fstat(f.fileno()))
+                metadata, raw = _read_packed_metadata(f)
+                start = f.tell()
+        except FileNotFoundError:
+            return None
+        if metadata is None:
+            return SessionReader(json.loads(raw))
+
+        # The file is opened again for each blob, rather than kept open for as long as the reader is, which can be
+        # as long as the session is. Saves replace the file, so if it's still the version that was opened, the
+        # blobs are where the metadata says.
+        def read_blob(i):
+            b = metadata["blobs"][i]
+            try:
+                with path.open("rb") as f:
+                    if file_version(os.fstat(f.fileno())) != version:
+                        raise StaleSessionError(f"Session {key} has changed since it was opened")
+                    f.seek(start + b["offset"])
+                    data = f.read(b["length"])
+            except FileNotFoundError:
+                raise StaleSessionError(f"Session {key} has been deleted since it was opened")
+            return decompress(data, b["codec"])
+
+        return SessionReader(metadata["document"], read_blob)
+
+    def write(self, key: str, document: dict):
+        stat = write_atomic(self._path(key), pack_session(document))
+        self.index.update(key, stat, len(document["data_series"]))
+        return file_version(stat)
+
+    def version(self, key: str):
+        try:
+            return file_version(self._path(key).stat())
+        except FileNotFoundError:
+            return None
+
+    def size(self, key: str) -> int | None:
+        try:
+            return self._path(key).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+        self.index.remove(key)
+
+    def sessions(self) -> List[SessionInfo]:
+        return self.index.sessions()
+
+    def __contains__(self, key: str) -> bool:
+        # the index only knows about sessions saved by other processes once it's refreshed
+        return key in self.index or self._path(key).exists()
+
+    def flush(self):
+        self.index.save()
+
+    def refresh(self):
+        self.index.load(self.directory)
+
+
+class SQLiteStorage(Storage):
+    # All sessions in one database. The document itself is stored as JSON, but with the data of each series and
+    # the CSV contents moved out into the blobs table, each compressed separately (see split_blobs). WAL mode
+    # lets readers carry on while a session is being written, and each write is a single transaction.
+    schema = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            key TEXT PRIMARY KEY,
+            modified REAL NOT NULL,
+            size INTEGER NOT NULL,
+            series_count INTEGER NOT NULL,
+            document TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS sessions_modified ON sessions (modified);
+        CREATE TABLE IF NOT EXISTS blobs (
+            key TEXT NOT NULL,
+            blob INTEGER NOT NULL,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (key, blob)
+        );
+    """
+
+    def __init__(self, path: Path, pool_size: int = 4):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # connections are shared by all of the sessions (threads) in this process, a connection at a time
+        self._pool = queue.Queue()
+        for _ in range(pool_size):
+            self._pool.put(self._connect())
+        with self._connection() as connection:
+            connection.executescript(self.schema)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # with WAL, NORMAL is still safe against corruption; only the last transactions can be lost on power loss
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    @contextmanager
+    def _connection(self):
+        connection = self._pool.get()
+        try:
+            yield connection
+        finally:
+            self._pool.put(connection)
+
+    def read(self, key: str) -> dict | None:
+        with self._connection() as connection:
+            row = connection.execute("SELECT document FROM sessions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            rows = connection.execute("SELECT blob, codec, data FROM blobs WHERE key = ? ORDER BY blob", (key,))
+            blobs = [decompress(data, codec) for _, codec, data in rows.fetchall()]
+        return join_blobs(json.loads(row[0]), blobs)
+
+    def read_metadata(self, key: str) -> dict | None:
+        with self._connection() as connection:
+            row = connection.execute("SELECT document FROM sessions WHERE key = ?", (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def open(self, key: str) -> SessionReader | None:
+        with self._connection() as connection:
+            row = connection.execute("SELECT document, modified FROM sessions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        document, modified = json.loads(row[0]), row[1]
+
+        def read_blob(i):
+            # only from the version of the session that was opened
+            with self._connection() as connection:
+                blob = connection.execute(
+                    "SELECT b.codec, b.data FROM blobs b JOIN sessions s ON s.key = b.key "
+                    "WHERE b.key = ? AND b.blob = ? AND s.modified = ?",
+                    (key, i, modified),
+                ).fetchone()
+            if blob is None:
+                raise StaleSessionError(f"Session {key} has changed since it was opened")
+            return decompress(blob[1], blob[0])
+
+        return SessionReader(document, read_blob)
+
+    def write(self, key: str, document: dict):
+        document, blobs = split_blobs(document)
+        text = json.dumps(document)
+        compressed = [(key, i, codec, data) for i, (codec, data) in enumerate(_compress_blobs(blobs))]
+        size = len(text) + sum(len(data) for *_, data in compressed)
+        modified = time.time()
+        with self._connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("DELETE FROM blobs WHERE key = ?", (key,))
+                connection.executemany("INSERT INTO blobs (key, blob, codec, data) VALUES (?, ?, ?, ?)", compressed)
+                connection.execute(
+                    "INSERT OR REPLACE INTO sessions (key, modified, size, series_count, document) VALUES (?, ?, ?, ?, ?)",
+                    (key, modified, size, len(document["data_series"]), text),
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return modified
+
+    def version(self, key: str):
+        with self._connection() as connection:
+            row = connection.execute("SELECT modified FROM sessions WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def size(self, key: str) -> int | None:
+        with self._connection() as connection:
+            row = connection.execute("SELECT size FROM sessions WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def delete(self, key: str):
+        with self._connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("DELETE FROM blobs WHERE key = ?", (key,))
+                connection.execute("DELETE FROM sessions WHERE key = ?", (key,))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def sessions(self) -> List[SessionInfo]:
+        with self._connection() as connection:
+            # modified is also the version
+            rows = connection.execute("SELECT key, modified, size, series_count, modified FROM sessions").fetchall()
+        return [SessionInfo(*row) for row in rows]
+
+    def __contains__(self, key: str) -> bool:
+        with self._connection() as connection:
+            return connection.execute("SELECT 1 FROM sessions WHERE key = ?", (key,)).fetchone() is not None
+
+
+def migrate(source: Path, destination: Path):
+    # copy every session from a JSON directory into an SQLite database, keeping their modification times
+    json_storage = JSONStorage(source)
+    sqlite_storage = SQLiteStorage(destination)
+    migrated = 0
+    for info in json_storage.sessions():
+        try:
+            document = json_storage.read(info.key)
+        except Exception as e:
+            logging.warning(f"Skipping {info.key}, which couldn't be read: {e}")
+            continue
+        if document is None:
+            continue
+        sqlite_storage.write(info.key, document)
+        with sqlite_storage._connection() as connection:
+            connection.execute("UPDATE sessions SET modified = ? WHERE key = ?", (info.modified, info.key))
+        migrated += 1
+    logging.info(f"Migrated {migrated} of {len(json_storage.sessions())} sessions to {destination}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Copy saved sessions from JSON files into an SQLite database.")
+    parser.add_argument("source", type=Path, help="the directory of JSON session files, e.g. data_cache")
+    parser.add_argument("destination", type=Path, help="the SQLite database to create or add to")
+    args = parser.parse_args()
+    migrate(args.source, args.destination)